@@ -6,11 +6,33 @@ class Config(BaseModel):
     test_records_path: str
     runner_infos_path: str
     jobs_path: str
+    jobs_db_path: str
+    # 没有事件唤醒时，调度器刷新runner状态的间隔
+    scheduler_sweep_interval_sec: float = 5.0
+    # 等待超过这个时间的任务不论优先级最先分发
+    queue_aging_sec: float = 1800
+    # 还没有完成过任务时，估计排队时间用的任务耗时
+    default_job_duration_sec: float = 3600
+    # 合并分片报告用，不配置时只生成链接到各分片报告的页面
+    pytest_html_merger: str | None = None
+    # runner通过这个地址下载版本
+    dispatcher_baseurl: str = "http://127.0.0.1:10899"
+    # runner下载版本时先尝试的、已经有这个版本的其他runner数量
+    build_peer_count: int = 3
+    # rdscore_versions_path 的磁盘配额，超过时删除最久没有使用的版本
+    versions_budget_bytes: int = 200 * 1024**3
+    # 不会被删除的版本名称
+    pinned_versions: list[str] = []
+    # 版本上传后提前推送给多少个同系统的空闲runner，0表示不推送
+    replicate_build_count: int = 2
+    # 提前推送占用的总带宽，0表示不限速
+    replicate_bandwidth_bytes_per_sec: int = 50 * 1024**2
 
 if os.name == "nt":  # Windows
     CONFIG = Config(
         rdscore_versions_path="D:/test/dispatcher/rdscore_versions",
         jobs_path="D:/test/dispatcher/jobs",
+        jobs_db_path="D:/test/dispatcher/jobs.db",
         test_records_path="D:/test/dispatcher/test_records",
         runner_infos_path="D:/test/dispatcher/runner_infos",
     )
@@ -18,6 +40,7 @@ else:
     CONFIG = Config(
         rdscore_versions_path="/tmp/coreci-dispatcher/rdscore_versions",
         jobs_path="/tmp/coreci-dispatcher/jobs",
+        jobs_db_path="/tmp/coreci-dispatcher/jobs.db",
         test_records_path="/tmp/coreci-dispatcher/test_records",
         runner_infos_path="/tmp/coreci-dispatcher/runner_infos",
     )
@@ -5,19 +5,30 @@
 2. 接收测试任务，分配给空闲的runner
 """
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 import json
 import logging
 import threading
 
-import aiofiles as aiofiles
-from fastapi import FastAPI, UploadFile, Request
-from fastapi.responses import HTMLResponse
+import requests
+
+from fastapi import FastAPI, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import UploadFile
 
-from dispatcher.runner_manager import RunnerManager, RunnerHandle
-from dispatcher.storage import VersionStorage, TestJobStorage
-from dispatcher.types import CreateTestJobRequest
+from dispatcher.config import CONFIG
+from dispatcher.runner_manager import RunnerManager, RunnerHandle, fetch_case_log
+from dispatcher.shards import report_dir
+from dispatcher.storage import (
+    TestJobStorage,
+    TestResultStorage,
+    VersionStorage,
+    parse_rdscore_version_from_filename,
+)
+from dispatcher.types import CreateTestJobRequest, RunnerEvent
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
 
@@ -28,6 +39,7 @@ logging.basicConfig(format=FORMAT, level=logging.INFO)
 runner_manager: RunnerManager | None = None
 version_storage: VersionStorage | None = None
 job_storage: TestJobStorage | None = None
+result_storage: TestResultStorage | None = None
 
 templates = Jinja2Templates(directory=str(Path(Path(__file__).resolve().parent, "templates")))
 
@@ -39,7 +51,9 @@ async def lifespan(app: FastAPI):
     version_storage = VersionStorage()
     global job_storage
     job_storage = TestJobStorage()
-    runner_manager = RunnerManager(version_storage, job_storage)
+    global result_storage
+    result_storage = TestResultStorage()
+    runner_manager = RunnerManager(version_storage, job_storage, result_storage)
     threading.Thread(group=None, target=runner_manager.run, daemon=True).start()
     app.mount("/",
               StaticFiles(directory=str(Path(__file__).resolve().parent / "dist")),
@@ -76,26 +90,226 @@ async def remove_runner(runner_id: str):
 
 @app.post("/api/jobs/submit/")
 async def submit_test_job(job: CreateTestJobRequest):
-    runner_manager.submit_job(job)
+    return runner_manager.submit_job(job)
+
+@app.get("/api/jobs/queue/{job_id}")
+async def get_queue_position(job_id: str):
+    position = runner_manager.get_queue_position(job_id)
+    if position is None:
+        return JSONResponse({"error": "job not found"}, status_code=404)
+    return position
+
+@app.get("/api/jobs/{job_id}/report")
+async def get_job_report(job_id: str):
+    """分片任务合并后的报告"""
+    path = report_dir(job_id) / "merged.html"
+    if not path.exists():
+        return JSONResponse({"error": "report not found"}, status_code=404)
+    return FileResponse(path, media_type="text/html")
+
+# 日志长轮询在自己的线程池里转发，不占用默认线程池；
+# 等待时间也比runner允许的短，线程池满时后面的请求不用排队太久
+LOG_PROXY_MAX_WORKERS = 8
+LOG_PROXY_MAX_WAIT_SEC = 10.0
+_log_proxy_executor = ThreadPoolExecutor(
+    max_workers=LOG_PROXY_MAX_WORKERS, thread_name_prefix="log-proxy"
+)
+
+@app.get("/api/jobs/{job_id}/log/{case}")
+async def tail_case_log(job_id: str, case: str, offset: int = 0, wait: float = 0):
+    """
+    转发到runner的日志接口，只传输 offset 之后的新内容
+
+    响应头 X-Log-Offset 是下一次请求的偏移量，X-Log-Complete 为 true 时日志已经完整
+    """
+    located = runner_manager.locate_case(job_id, case)
+    if located is None:
+        return JSONResponse({"error": "job not found"}, status_code=404)
+    job, runner = located
+    try:
+        res = await asyncio.get_running_loop().run_in_executor(
+            _log_proxy_executor,
+            fetch_case_log,
+            job,
+            runner,
+            case,
+            offset,
+            min(max(wait, 0.0), LOG_PROXY_MAX_WAIT_SEC),
+        )
+    except requests.RequestException as e:
+        return JSONResponse({"error": f"runner unreachable: {e!r}"}, status_code=502)
+    headers = {
+        key: value
+        for key, value in res.headers.items()
+        if key.lower().startswith("x-log-")
+    }
+    return Response(
+        res.content,
+        status_code=res.status_code,
+        media_type=res.headers.get("content-type"),
+        headers=headers,
+    )
+
+@app.get("/api/results")
+async def query_test_results(
+    version: str | None = None,
+    os: str | None = None,
+    mark: str | None = None,
+    case: str | None = None,
+    nodeid: str | None = None,
+    outcome: str | None = None,
+    job_id: str | None = None,
+    order_by: str = "finish_time",
+    limit: int = 100,
+):
+    """
+    按测试查询结果，例如
+    /api/results?version=0.2.0.250707&outcome=failed
+    /api/results?mark=m0&order_by=duration_sec&limit=50
+    """
+    filters = {
+        "rdscore_version": version,
+        "os": os,
+        "testcase_mark": mark,
+        "case_name": case,
+        "nodeid": nodeid,
+        "outcome": outcome,
+        "job_id": job_id,
+    }
+    return result_storage.query(
+        {field: value for field, value in filters.items() if value is not None},
+        order_by,
+        max(1, min(limit, 1000)),
+    )
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+async def _iter_upload(file: UploadFile):
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
 
 @app.post("/api/versions/upload/{expected_md5}")
-async def upload_build(file: UploadFile, expected_md5: str):
-    version_storage.add_rdscore_zip(file.file.read(), file.filename, expected_md5)
+async def upload_build(expected_md5: str, request: Request, filename: str = ""):
+    """
+    上传版本zip，支持两种请求：
+    1. multipart表单，文件字段名为 file(网页上传)
+    2. 请求体就是zip，文件名放在 filename 参数中，直接从请求体边接收边写文件，不经过临时文件，例如
+       curl --data-binary @linux-0.2.0.250707.zip \
+           "/api/versions/upload/{md5}?filename=linux-0.2.0.250707.zip"
+    """
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        try:
+            file = form.get("file")
+            if not isinstance(file, UploadFile):
+                return JSONResponse({"error": "missing file field"}, status_code=400)
+            version, error = await _save_upload(
+                _iter_upload(file), file.filename or "", expected_md5
+            )
+        finally:
+            await form.close()
+    else:
+        version, error = await _save_upload(request.stream(), filename, expected_md5)
+    if version is None:
+        return JSONResponse({"error": error}, status_code=400)
+    version_storage.touch(version.name)
+    _enforce_versions_budget()
+    runner_manager.replicate_build(version)
+    return version
+
+
+async def _save_upload(chunks, filename: str, expected_md5: str):
+    """返回 (版本, 错误信息)"""
+    if parse_rdscore_version_from_filename(Path(filename).name) is None:
+        return None, f"invalid filename {filename!r}"
+    version = await version_storage.save_rdscore_stream(chunks, filename, expected_md5)
+    if version is None:
+        return None, f"md5 does not match {expected_md5}"
+    return version, None
+
+
+def _enforce_versions_budget():
+    """等待和执行中的任务使用的版本不会被删除"""
+    protected = set(CONFIG.pinned_versions)
+    for status in ("waiting", "running"):
+        protected.update(
+            job.rdscore_version
+            for job in job_storage.list_test_jobs_by_status(status)
+        )
+    for version in version_storage.enforce_budget(CONFIG.versions_budget_bytes, protected):
+        logging.info(f"evicted version {version.name} to stay within the disk budget")
 
 @app.get("/api/versions/list/")
 async def list_versions():
     return version_storage.list_versions()
 
+@app.get("/api/versions/latest/{os}/{version_prefix}")
+async def get_latest_version(os: str, version_prefix: str):
+    version = version_storage.get_latest_version(version_prefix, os)
+    if version is None:
+        return JSONResponse({"error": "version not found"}, status_code=404)
+    return version
+
 @app.get("/api/versions/download/{version_name}")
-async def download_version(version_name: str):
-    version_path = Path(version_storage.rdscore_versions_path) / version_name
+async def download_version(version_name: str, request: Request):
+    """
+    下载版本zip，md5作为ETag
+
+    FileResponse 支持 Range 请求，服务器支持时会走 sendfile/pathsend
+    """
+    version = version_storage.get_version_info(Path(version_name).stem)
+    if version is None:
+        return JSONResponse({"error": "version not found"}, status_code=404)
+    version_path = Path(CONFIG.rdscore_versions_path) / f"{version.name}.zip"
     if not version_path.exists():
-        return {"error": "version not found"}
-    async with aiofiles.open(version_path, mode='rb') as f:
-        content = await f.read()
-    return HTMLResponse(content=content, media_type="application/zip", headers={"Content-Disposition": f"attachment; filename={version_name}"})
+        return JSONResponse({"error": "version not found"}, status_code=404)
+    version_storage.touch(version.name)
+    etag = f'"{version.md5}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"etag": etag})
+    return FileResponse(
+        version_path,
+        media_type="application/zip",
+        filename=version_path.name,
+        headers={"etag": etag},
+    )
 
 
 @app.get("/api/jobs/list/active")
 async def list_active_jobs():
-    return runner_manager.get_active_jobs()
\ No newline at end of file
+    return runner_manager.get_active_jobs()
+
+@app.post("/api/events/")
+async def receive_runner_events(events: list[RunnerEvent]):
+    """runner推送的任务事件，一次可以推送多个"""
+    runner_manager.handle_runner_events(events)
+    return {"received": len(events)}
+
+
+# 没有事件时定期发送注释，防止代理断开连接
+SSE_KEEPALIVE_SEC = 15
+
+
+@app.get("/api/events/stream")
+async def stream_events():
+    """任务事件的SSE流，网页用 EventSource 订阅"""
+    queue = runner_manager.event_hub.subscribe()
+
+    async def messages():
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SEC)
+                except TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            runner_manager.event_hub.unsubscribe(queue)
+
+    return StreamingResponse(
+        messages(),
+        media_type="text/event-stream",
+        headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+    )
@@ -0,0 +1,43 @@
+"""
+把任务事件推送给网页客户端(SSE)
+
+runner推送的事件和dispatcher自己产生的任务状态变化都通过 EventHub 广播，
+每个客户端一个有界队列，客户端太慢时丢弃最旧的事件
+"""
+
+import asyncio
+import threading
+
+from pydantic import BaseModel
+
+
+class EventHub:
+    def __init__(self, max_queued: int = 1000):
+        self.max_queued = max_queued
+        self._subscribers: dict[asyncio.Queue, asyncio.AbstractEventLoop] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> asyncio.Queue:
+        """在客户端所在的事件循环中调用"""
+        queue = asyncio.Queue(maxsize=self.max_queued)
+        with self._lock:
+            self._subscribers[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers.pop(queue, None)
+
+    @staticmethod
+    def _put(queue: asyncio.Queue, message: str):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(message)
+
+    def publish(self, event_type: str, payload: BaseModel):
+        """可以在任意线程调用，消息按SSE格式编码一次后发给所有客户端"""
+        message = f"event: {event_type}\ndata: {payload.model_dump_json()}\n\n"
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for queue, loop in subscribers:
+            loop.call_soon_threadsafe(self._put, queue, message)
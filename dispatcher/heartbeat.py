@@ -0,0 +1,142 @@
+"""
+runner心跳
+
+1. 并发探测所有runner，共用一个keep-alive连接池
+2. 每次探测都有超时，卡住的runner不会拖住整轮心跳
+3. 连续失败的runner按带抖动的指数退避减少探测
+4. 记录每个runner的往返时间
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from dispatcher.types import RunnerHandle
+
+
+class _ProbeState:
+    def __init__(self):
+        self.failures = 0
+        self.next_probe_at = 0.0
+
+
+class HeartbeatEngine:
+    def __init__(
+        self,
+        max_workers: int = 64,
+        timeout_sec: float = 2.0,
+        base_backoff_sec: float = 1.0,
+        max_backoff_sec: float = 60.0,
+    ):
+        """max_workers 是初始的并发数，runner更多时自动扩大，保证一轮心跳只需要一次往返"""
+        self.timeout_sec = timeout_sec
+        self.base_backoff_sec = base_backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.session = requests.Session()
+        self._workers = 0
+        self._executor: ThreadPoolExecutor | None = None
+        self._ensure_workers(max_workers)
+        self._states: dict[str, _ProbeState] = {}
+
+    def _ensure_workers(self, count: int):
+        """线程池和连接池至少能同时探测 count 个runner"""
+        if count <= self._workers:
+            return
+        adapter = HTTPAdapter(pool_connections=count, pool_maxsize=count)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._executor = ThreadPoolExecutor(
+            max_workers=count, thread_name_prefix="heartbeat"
+        )
+        self._workers = count
+
+    def _probe(self, runner: RunnerHandle) -> tuple[int, dict | None, float]:
+        # requests的timeout只限制连接和每次读取，读响应体时再检查总的截止时间；
+        # 截止时间从实际开始探测算起，不包括在线程池中排队的时间
+        start = time.monotonic()
+        deadline = start + self.timeout_sec * 2
+        body = bytearray()
+        with self.session.get(
+            f"{runner.baseurl}/info", timeout=self.timeout_sec, stream=True
+        ) as res:
+            for chunk in res.iter_content(64 * 1024):
+                body += chunk
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"/info took more than {self.timeout_sec * 2}s")
+        rtt = time.monotonic() - start
+        info = json.loads(body) if res.status_code == 200 else None
+        if info is not None and not isinstance(info, dict):
+            raise ValueError(f"/info returned {type(info).__name__}, expected an object")
+        return res.status_code, info, rtt
+
+    def _backoff(self, state: _ProbeState) -> float:
+        delay = min(
+            self.max_backoff_sec,
+            self.base_backoff_sec * 2 ** (state.failures - 1),
+        )
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _probe_one(self, runner: RunnerHandle) -> dict | None:
+        state = self._states.setdefault(runner.id, _ProbeState())
+        loop = asyncio.get_running_loop()
+        try:
+            status_code, info, rtt = await loop.run_in_executor(
+                self._executor, self._probe, runner
+            )
+        except (requests.RequestException, TimeoutError, ValueError) as e:
+            logging.error(f"Failed to ping runner {runner.id}: {e!r}")
+            runner.status = "error"
+            info = None
+        else:
+            runner.rtt_ms = round(rtt * 1000, 2)
+            if info is not None:
+                runner.status = "idle" if not info.get("current_job") else "running"
+                runner.queue_free = max(
+                    0, info.get("queue_limit", 0) - info.get("queued_jobs", 0)
+                )
+                runner.testcase_revision = info.get("testcase_revision", "")
+                runner.build_md5s = info.get("build_md5s", [])
+                runner.last_heartbeat = datetime.datetime.now().isoformat()
+            else:
+                logging.error(f"Runner {runner.id} /info returned {status_code}")
+                runner.status = "ping-failed"
+        if info is None:
+            state.failures += 1
+            state.next_probe_at = time.monotonic() + self._backoff(state)
+        else:
+            state.failures = 0
+            state.next_probe_at = 0.0
+        return info
+
+    async def sweep(self, runners: list[RunnerHandle]) -> dict[str, dict]:
+        """
+        并发探测所有到期的runner
+
+        返回探测成功的 runner id -> /info 结果，处于退避期的runner跳过，状态不变
+        """
+        now = time.monotonic()
+        due = [
+            runner
+            for runner in runners
+            if self._states.setdefault(runner.id, _ProbeState()).next_probe_at
+            <= now
+        ]
+        self._ensure_workers(len(due))
+        results = await asyncio.gather(*(self._probe_one(r) for r in due))
+        return {
+            runner.id: info
+            for runner, info in zip(due, results)
+            if info is not None
+        }
+
+    def forget(self, runner_id: str):
+        self._states.pop(runner_id, None)
@@ -0,0 +1,142 @@
+"""
+等待中的任务队列
+
+1. 同一个提交者的任务按优先级和提交顺序排队
+2. 不同提交者之间按加权公平队列(WFQ)轮流出队，优先级越高权重越大
+3. 等待时间超过 aging_sec 的任务按等待时间最先出队，低优先级任务不会饿死
+"""
+
+import datetime
+from collections.abc import Iterator
+import heapq
+import itertools
+import threading
+import time
+
+from dispatcher.types import TestJob
+
+MIN_PRIORITY = -4
+MAX_PRIORITY = 4
+
+
+def priority_weight(priority: int) -> float:
+    """优先级每高一级，同样时间内能出队的任务数翻倍"""
+    return 2.0 ** max(MIN_PRIORITY, min(MAX_PRIORITY, priority))
+
+
+def submit_timestamp(job: TestJob) -> float:
+    try:
+        return datetime.datetime.fromisoformat(job.start_time).timestamp()
+    except ValueError:
+        return time.time()
+
+
+class WaitingQueue:
+    """
+    两个堆，都按需弹出，只有实际看过的条目才付出 O(log n)：
+    _heap 按虚拟完成时间(公平顺序)，_by_submit 按提交时间，
+    后者堆顶等待超过 aging_sec 的任务就是老化任务，先于公平顺序出队
+    """
+
+    def __init__(self, aging_sec: float = 1800):
+        self.aging_sec = aging_sec
+        # (virtual_finish_tag, seq, job_id)，被移除的任务延迟删除
+        self._heap: list[tuple[float, int, str]] = []
+        # (submit_timestamp, seq, job_id)，同样延迟删除
+        self._by_submit: list[tuple[float, int, str]] = []
+        self._entries: dict[str, tuple[float, int, str]] = {}
+        self._jobs: dict[str, TestJob] = {}
+        # submitter -> 最后一个任务的虚拟完成时间
+        self._last_tag: dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        # 遍历期间调用方可能移除任务，用可重入锁
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, job_id: str):
+        return job_id in self._jobs
+
+    def push(self, job: TestJob):
+        with self._lock:
+            if job.id in self._jobs:
+                self._jobs[job.id] = job
+                return
+            start = max(self._virtual_time, self._last_tag.get(job.submitter, 0.0))
+            tag = start + 1.0 / priority_weight(job.priority)
+            self._last_tag[job.submitter] = tag
+            entry = (tag, next(self._seq), job.id)
+            self._entries[job.id] = entry
+            self._jobs[job.id] = job
+            heapq.heappush(self._heap, entry)
+            heapq.heappush(self._by_submit, (submit_timestamp(job), entry[1], job.id))
+
+    def _is_live(self, entry: tuple[float, int, str]) -> bool:
+        """同一个id移除后重新加入时，旧条目的序号不同，也是失效条目"""
+        current = self._entries.get(entry[2])
+        return current is not None and current[1] == entry[1]
+
+    def remove(self, job_id: str) -> TestJob | None:
+        with self._lock:
+            return self._remove(job_id)
+
+    def _remove(self, job_id: str) -> TestJob | None:
+        self._entries.pop(job_id, None)
+        job = self._jobs.pop(job_id, None)
+        # 堆顶的失效条目顺手清掉，其他的等出队时再清
+        for heap in (self._heap, self._by_submit):
+            while heap and not self._is_live(heap[0]):
+                heapq.heappop(heap)
+            # 失效条目太多时整体重建，堆的大小和等待任务数同一个量级
+            if len(heap) > 2 * len(self._entries) + 64:
+                heap[:] = [entry for entry in heap if self._is_live(entry)]
+                heapq.heapify(heap)
+        return job
+
+    def served(self, job_id: str):
+        """任务已经分发出去，虚拟时钟前进到这个任务的完成时间"""
+        with self._lock:
+            entry = self._entries.get(job_id)
+            if entry is None:
+                return
+            self._virtual_time = max(self._virtual_time, entry[0])
+            self._remove(job_id)
+
+    def iter_ordered(self) -> Iterator[TestJob]:
+        """
+        按出队顺序逐个返回等待中的任务，不修改队列
+
+        从堆中弹出看过的条目，迭代结束或关闭时放回，调用方提前退出时只付出看过的部分；
+        迭代期间持有锁，调用方应该用 contextlib.closing 保证及时关闭
+        """
+        with self._lock:
+            cutoff = time.time() - self.aging_sec
+            popped: list[tuple[list, tuple[float, int, str]]] = []
+            returned: set[str] = set()
+            try:
+                while True:
+                    if self._by_submit and self._by_submit[0][0] <= cutoff:
+                        heap = self._by_submit
+                    elif self._heap:
+                        heap = self._heap
+                    else:
+                        return
+                    entry = heapq.heappop(heap)
+                    if not self._is_live(entry):
+                        continue
+                    popped.append((heap, entry))
+                    # 老化任务已经按提交时间返回过，在公平顺序中跳过
+                    if entry[2] in returned:
+                        continue
+                    returned.add(entry[2])
+                    yield self._jobs[entry[2]]
+            finally:
+                for heap, entry in popped:
+                    if self._is_live(entry):
+                        heapq.heappush(heap, entry)
+
+    def ordered(self) -> list[TestJob]:
+        """按出队顺序返回所有等待中的任务，不修改队列"""
+        return list(self.iter_ordered())
@@ -0,0 +1,105 @@
+"""
+版本上传后提前推送给空闲runner
+
+1. 上传完成后在后台把版本推送给几个同系统的空闲runner，任务分发时不用再下载
+2. 所有推送共用一个令牌桶限速，不占满dispatcher的上行带宽
+3. 同一个版本不会同时向同一个runner推送两次
+"""
+
+import logging
+import random
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from dispatcher.types import RDSCoreVersion, RunnerHandle
+
+SEND_CHUNK_SIZE = 256 * 1024
+
+
+class RateLimiter:
+    """令牌桶，bytes_per_sec 为0时不限速，可以在多个线程中共用"""
+
+    def __init__(self, bytes_per_sec: int):
+        self.bytes_per_sec = bytes_per_sec
+        self._lock = threading.Lock()
+        self._next_free = time.monotonic()
+
+    def acquire(self, nbytes: int):
+        if self.bytes_per_sec <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_free)
+            self._next_free = start + nbytes / self.bytes_per_sec
+        if start > now:
+            time.sleep(start - now)
+
+    def iter_file(self, path: Path):
+        with open(path, "rb") as f:
+            while chunk := f.read(SEND_CHUNK_SIZE):
+                self.acquire(len(chunk))
+                yield chunk
+
+
+class BuildReplicator:
+    def __init__(
+        self,
+        send: Callable[[Path, RDSCoreVersion, RunnerHandle, RateLimiter], bool],
+        copies: int,
+        bytes_per_sec: int,
+        max_workers: int = 2,
+    ):
+        """send 负责实际推送一个版本，copies 是上传后希望有这个版本的runner数量"""
+        self._send_version = send
+        self.copies = copies
+        self.limiter = RateLimiter(bytes_per_sec)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="build-replicator"
+        )
+        self._lock = threading.Lock()
+        # (md5, runner_id) 正在推送
+        self._in_flight: set[tuple[str, str]] = set()
+
+    def replicate(
+        self, version: RDSCoreVersion, zip_path: Path, runners: list[RunnerHandle]
+    ) -> list[str]:
+        """选出要推送的runner并在后台推送，立即返回选中的runner id"""
+        with self._lock:
+            holders = sum(
+                1
+                for runner in runners
+                if runner.os == version.os
+                and (
+                    version.md5 in runner.build_md5s
+                    or (version.md5, runner.id) in self._in_flight
+                )
+            )
+            candidates = [
+                runner
+                for runner in runners
+                if runner.os == version.os
+                and runner.status == "idle"
+                and version.md5 not in runner.build_md5s
+                and (version.md5, runner.id) not in self._in_flight
+            ]
+            random.shuffle(candidates)
+            targets = candidates[: max(0, self.copies - holders)]
+            for runner in targets:
+                self._in_flight.add((version.md5, runner.id))
+        for runner in targets:
+            self._executor.submit(self._send, version, zip_path, runner)
+        return [runner.id for runner in targets]
+
+    def _send(self, version: RDSCoreVersion, zip_path: Path, runner: RunnerHandle):
+        try:
+            self._send_version(zip_path, version, runner, self.limiter)
+        except (OSError, requests.RequestException) as e:
+            logging.error(f"Failed to replicate {version.name} to runner {runner.id}: {e!r}")
+        finally:
+            with self._lock:
+                self._in_flight.discard((version.md5, runner.id))
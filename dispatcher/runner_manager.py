@@ -1,6 +1,12 @@
+import asyncio
+from collections import deque
+import concurrent.futures
+from contextlib import closing
+import datetime
+from enum import StrEnum
 import logging
 from pathlib import Path
-import sqlite3
+import random
 import time
 import requests
 
@@ -8,37 +14,161 @@ import uuid
 import os
 
 from dispatcher.config import CONFIG
-from dispatcher.types import CreateTestJobRequest, RunnerHandle, TestJob
-from dispatcher.storage import VersionStorage, TestJobStorage
+from dispatcher.events import EventHub
+from dispatcher.heartbeat import HeartbeatEngine
+from dispatcher.job_queue import WaitingQueue
+from dispatcher.replication import BuildReplicator, RateLimiter
+from dispatcher.shards import (
+    estimate_durations,
+    make_shards,
+    merge_shard_reports,
+    merge_shard_results,
+    split_cases,
+)
+from dispatcher.types import (
+    CreateTestJobRequest,
+    CreateTestJobResponse,
+    QueuePosition,
+    RDSCoreVersion,
+    RunnerEvent,
+    RunnerHandle,
+    TestJob,
+)
+from dispatcher.storage import VersionStorage, TestJobStorage, TestResultStorage
 
-def send_version(zip_file: bytes, expected_md5: str, runner: RunnerHandle):
-    res = requests.post(f"{runner.baseurl}/test/storage/versions/upload/{expected_md5}", files={"file": zip_file})
-    logging.info(f"try to send version {runner.id} {res.text}")
+# 推送版本时读取响应的超时，runner收完后还要解压
+SEND_VERSION_TIMEOUT_SEC = (10, 600)
+
+
+def send_version(
+    zip_path: Path,
+    version: RDSCoreVersion,
+    runner: RunnerHandle,
+    limiter: RateLimiter | None = None,
+) -> bool:
+    """
+    把版本zip流式推送给runner，runner已经上报有这个版本时跳过
+
+    limiter 不为空时按它限速(分块传输)；返回是否实际发送了
+    """
+    if version.md5 in runner.build_md5s:
+        logging.info(f"runner {runner.id} already has {version.name}, skip sending")
+        return False
+    url = f"{runner.baseurl}/test/storage/versions/upload/{version.md5}"
+    params = {"name": version.name}
+    if limiter is None:
+        with open(zip_path, "rb") as f:
+            res = requests.post(
+                url, params=params, data=f, timeout=SEND_VERSION_TIMEOUT_SEC
+            )
+    else:
+        # iter_file 自己打开文件
+        res = requests.post(
+            url,
+            params=params,
+            data=limiter.iter_file(zip_path),
+            timeout=SEND_VERSION_TIMEOUT_SEC,
+        )
+    res.raise_for_status()
+    logging.info(f"sent version {version.name} to runner {runner.id}: {res.text}")
+    runner.build_md5s.append(version.md5)
+    return True
+
+
+def _log_future_exception(future: concurrent.futures.Future):
+    """提交到调度线程的协程没有人等待结果，异常只能在这里记录"""
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(
+            "Scheduled coroutine failed", exc_info=future.exception()
+        )
+
+
+# 分发任务时单次请求的超时
+DISPATCH_TIMEOUT_SEC = 10
 
 
 def accept_job(job: CreateTestJobRequest, runner: RunnerHandle):
-    res = requests.post(f"{runner.baseurl}/test/job/accept", json=job.dict())
+    res = requests.post(f"{runner.baseurl}/test/job/accept", json=job.dict(), timeout=DISPATCH_TIMEOUT_SEC)
     logging.info(f"try to accept job {runner.id} {res.text}")
     return res.json()["accepted"]
 
 
 def send_job(job: CreateTestJobRequest, runner: RunnerHandle):
-    res = requests.post(f"{runner.baseurl}/test/job", json=job.dict())
+    res = requests.post(f"{runner.baseurl}/test/job", json=job.dict(), timeout=DISPATCH_TIMEOUT_SEC)
     logging.info(res)
     logging.info(res.text)
     return res.json()
 
+def fetch_test_cases(runner: RunnerHandle) -> list[str]:
+    res = requests.get(f"{runner.baseurl}/test/cases", timeout=DISPATCH_TIMEOUT_SEC)
+    res.raise_for_status()
+    return res.json()
+
+
+def fetch_runner_job(job: TestJob, runner: RunnerHandle) -> dict:
+    res = requests.get(f"{runner.baseurl}/test/job/{job.id}", timeout=DISPATCH_TIMEOUT_SEC)
+    return res.json()
+
+def fetch_case_log(
+    job: TestJob, runner: RunnerHandle, case: str, offset: int, wait: float
+) -> requests.Response:
+    return requests.get(
+        f"{runner.baseurl}/test/job/{job.id}/log/{case}",
+        params={"offset": offset, "wait": wait},
+        timeout=wait + DISPATCH_TIMEOUT_SEC,
+    )
+
+
+class SchedulerEvent(StrEnum):
+    job_submitted = "job_submitted"
+    runner_idle = "runner_idle"
+    runner_added = "runner_added"
+
+
 class RunnerManager:
-    def __init__(self, version_storage: VersionStorage, job_storage: TestJobStorage):
+    def __init__(
+        self,
+        version_storage: VersionStorage,
+        job_storage: TestJobStorage,
+        result_storage: TestResultStorage,
+    ):
         self.runners: list[RunnerHandle] = []
         self._load_runner_infos()
+        self.heartbeat = HeartbeatEngine()
         self.version_storage = version_storage
         self.job_storage = job_storage
-        
+        self.result_storage = result_storage
+        self.waiting = WaitingQueue(CONFIG.queue_aging_sec)
+        for job in self.job_storage.list_test_jobs_by_status("waiting"):
+            self.waiting.push(job)
+        # 最近完成任务耗时的滑动平均，用于估计排队任务的开始时间
+        self.avg_job_duration_sec = CONFIG.default_job_duration_sec
+        # 调度线程启动后才会创建
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._events: asyncio.Queue[SchedulerEvent] | None = None
+        # 任务状态变化推送给网页客户端
+        self.event_hub = EventHub()
+        # 上传的版本提前推送给空闲runner
+        self.replicator = BuildReplicator(
+            send_version,
+            CONFIG.replicate_build_count,
+            CONFIG.replicate_bandwidth_bytes_per_sec,
+        )
+
     def get_all_runners(self):
         return self.runners
 
-    def submit_job(self, job_req: CreateTestJobRequest):
+    def replicate_build(self, version: RDSCoreVersion) -> list[str]:
+        """版本上传后在后台推送给同系统的空闲runner，返回选中的runner id"""
+        if CONFIG.replicate_build_count <= 0:
+            return []
+        zip_path = Path(CONFIG.rdscore_versions_path) / f"{version.name}.zip"
+        targets = self.replicator.replicate(version, zip_path, list(self.runners))
+        if targets:
+            logging.info(f"replicating {version.name} to runners {targets}")
+        return targets
+
+    def submit_job(self, job_req: CreateTestJobRequest) -> CreateTestJobResponse:
         if job_req.id is None:
             job_req.id = str(uuid.uuid1())
         if job_req.os is None:
@@ -49,23 +179,45 @@ class RunnerManager:
                     job_req.os = version_info.os
                 else:
                     logging.error(f"Version {job_req.rdscore_version} not found in storage.")
-                    return
+                    return CreateTestJobResponse(error=f"version {job_req.rdscore_version} not found")
             else:
                 logging.error("Job OS is not specified and rdscore_version is not provided.")
-                return
+                return CreateTestJobResponse(error="os or rdscore_version is required")
         if job_req.os not in ["windows", "linux"]:
             logging.error(f"Unsupported OS: {job_req.os}. Only 'windows' and 'linux' are supported.")
-            return
+            return CreateTestJobResponse(error=f"unsupported os {job_req.os}")
         if job_req.rdscore_version is None:
             logging.error("Job rdscore_version is not specified.")
-            return
+            return CreateTestJobResponse(error="rdscore_version is required")
+        version_info = self.version_storage.get_version_info(job_req.rdscore_version)
+        if version_info is None:
+            logging.error(f"Version {job_req.rdscore_version} not found in storage.")
+            return CreateTestJobResponse(error=f"version {job_req.rdscore_version} not found")
         # check if job already exists
         existing_job = self.job_storage.get_test_job_by_id(job_req.id)
         if existing_job is not None:
             logging.warning(f"Job with ID {job_req.id} already exists. Updating job status to 'waiting'.")
             existing_job.status = "waiting"
             self.job_storage.update_test_job(existing_job)
-            return
+            self.waiting.push(existing_job)
+            self.notify(SchedulerEvent.job_submitted)
+            return CreateTestJobResponse(created=True, job_id=existing_job.id)
+        testcase_revision = job_req.testcase_revision or self._runner_testcase_revision(job_req.os)
+        cache_key = (
+            f"{version_info.md5}:{job_req.testcase_mark}:{testcase_revision}"
+            if testcase_revision
+            else ""
+        )
+        if cache_key and job_req.use_cache:
+            cached = self._find_cached_job(cache_key)
+            if cached is not None:
+                logging.info(f"Job {job_req.id} reuses job {cached.id} ({cached.status}).")
+                return CreateTestJobResponse(
+                    job_id=cached.id,
+                    runner_id=cached.runner_id or None,
+                    cached=cached.status == "finished",
+                    attached=cached.status != "finished",
+                )
         # add job to jobs_to_dispatch
         job = TestJob(
             id=job_req.id,
@@ -75,10 +227,41 @@ class RunnerManager:
             rdscore_version=job_req.rdscore_version,
             status="waiting",
             start_time=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+            priority=job_req.priority,
+            submitter=job_req.submitter,
+            max_shards=job_req.max_shards,
+            rdscore_file_url=f"{CONFIG.dispatcher_baseurl}/api/versions/download/{version_info.name}.zip",
+            rdscore_md5=version_info.md5,
+            events_url=f"{CONFIG.dispatcher_baseurl}/api/events/",
+            testcase_revision=testcase_revision,
+            cache_key=cache_key,
         )
+        self.version_storage.touch(job.rdscore_version)
         self.job_storage.add_test_job(job)
+        self.waiting.push(job)
+        self.event_hub.publish("job_updated", job)
         logging.info(f"Submitting job {job_req.id} for OS {job_req.os} with rdscore version {job_req.rdscore_version}.")
-                
+        self.notify(SchedulerEvent.job_submitted)
+        return CreateTestJobResponse(created=True, job_id=job.id)
+
+    def _runner_testcase_revision(self, os: str) -> str:
+        """
+        没有指定用例版本时，使用这个系统的runner上报的commit
+
+        runner之间不一致或者未知时返回空字符串，这样的任务不参与结果复用
+        """
+        revisions = {runner.testcase_revision for runner in self.runners if runner.os == os}
+        if len(revisions) != 1:
+            return ""
+        return revisions.pop()
+
+    def _find_cached_job(self, cache_key: str) -> TestJob | None:
+        """最近一个相同的已完成、正在运行或等待中的任务，失败的任务不复用"""
+        for job in reversed(self.job_storage.list_test_jobs_by_cache_key(cache_key)):
+            if job.status in ("finished", "running", "waiting"):
+                return job
+        return None
+
     def _load_runner_infos(self):
         # 从文件夹中扫描runner
         self.runners = []
@@ -114,14 +297,13 @@ class RunnerManager:
         file_path = Path(CONFIG.runner_infos_path) / f"{runner_info.id}.json"
         if file_path.exists():
             logging.warning(f"Runner with ID {runner_info.id} already exists. Updating existing runner.")
-            with open(file_path, 'w') as f:
-                f.write(runner_info.model_dump_json())
-            return
         with open(file_path, 'w') as f:
             f.write(runner_info.model_dump_json())
+        self.notify(SchedulerEvent.runner_added)
 
     def remove_runner(self, runner_id: str):
         self.runners = [runner for runner in self.runners if runner.id != runner_id]
+        self.heartbeat.forget(runner_id)
         logging.info(f"Removed runner with ID {runner_id} from the manager.")
         # remove runner info file
         file_path = Path(CONFIG.runner_infos_path) / f"{runner_id}.json"
@@ -131,79 +313,454 @@ class RunnerManager:
         else:
             logging.warning(f"Runner info file {file_path} does not exist. Cannot remove.")
 
+    def locate_case(self, job_id: str, case: str) -> tuple[TestJob, RunnerHandle] | None:
+        """找到执行测试目录的任务和runner，分片任务查找包含这个目录的子任务"""
+        job = self.job_storage.get_test_job_by_id(job_id)
+        if job is None:
+            return None
+        for shard_id in job.shard_ids:
+            shard = self.job_storage.get_test_job_by_id(shard_id)
+            if shard is not None and shard.cases and case in shard.cases:
+                job = shard
+                break
+        runner = next(
+            (runner for runner in self.runners if runner.id == job.runner_id), None
+        )
+        if runner is None:
+            return None
+        return job, runner
+
+    def notify(self, event: SchedulerEvent):
+        """
+        唤醒调度器，可以在任意线程调用
+
+        调度器还没启动时直接丢弃事件，启动后的第一轮调度会处理所有等待的任务
+        """
+        loop = self._loop
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    def handle_runner_events(self, events: list[RunnerEvent]):
+        """
+        处理runner推送的事件，转发给网页客户端
+
+        结束事件在调度线程中完成任务并立即调度下一个任务，
+        定时轮询仍然保留，用于处理丢失的事件
+        """
+        for event in events:
+            job = self.job_storage.get_test_job_by_id(event.job_id)
+            if job is None:
+                logging.warning(f"Event {event.type} for unknown job {event.job_id}.")
+                continue
+            event.runner_id = job.runner_id
+            self.event_hub.publish(event.type, event)
+            if event.type == "case_finished" and event.tests:
+                self.result_storage.add_case_results(job, event.case, event.tests)
+            if event.type == "case_finished" and event.duration_sec is not None:
+                self.result_storage.record_case_duration(job, event.case, event.duration_sec)
+            if job.status != "running":
+                continue
+            if event.type == "case_finished" and event.case not in job.tested_cases:
+                job.tested_cases.append(event.case)
+                self.job_storage.transition_test_job(job, "running")
+            elif event.type == "job_finished":
+                runner = next(
+                    (runner for runner in self.runners if runner.id == job.runner_id),
+                    None,
+                )
+                loop = self._loop
+                if runner is None or loop is None:
+                    continue
+                runner_job = {
+                    "runner_status": event.status,
+                    "error": event.error,
+                    "finished_cases": event.finished_cases or job.tested_cases,
+                }
+                future = asyncio.run_coroutine_threadsafe(
+                    self._complete_job(job, runner, runner_job), loop
+                )
+                future.add_done_callback(_log_future_exception)
+                self.notify(SchedulerEvent.runner_idle)
+
     def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        """
+        调度循环
+
+        收到事件(提交任务、runner变为空闲、添加runner)后立即调度，
+        没有事件时每隔 scheduler_sweep_interval_sec 刷新一次runner状态再调度
+        """
+        self._events = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        next_sweep_at = 0.0
         while True:
-            time.sleep(1)
-            self.refresh_runner_status()
-            if self.process_jobs():
-                break
+            timeout = max(0.0, next_sweep_at - time.monotonic())
+            try:
+                event = await asyncio.wait_for(self._events.get(), timeout)
+            except TimeoutError:
+                event = None
+            # 合并同一时刻到达的多个事件，只调度一次
+            while not self._events.empty():
+                self._events.get_nowait()
+            if event is None:
+                # 这一轮出错也按间隔重试，不会连续空转
+                next_sweep_at = (
+                    time.monotonic() + CONFIG.scheduler_sweep_interval_sec
+                )
+            # 任何异常都只结束这一轮，调度线程不能退出
+            try:
+                if event is None:
+                    await self.refresh_runner_status()
+                    await self.refresh_running_jobs()
+                else:
+                    logging.info(f"Scheduler woken up by {event.value}.")
+                    if event == SchedulerEvent.runner_idle:
+                        # runner结束任务后可能还有排队的任务，先确认它的状态
+                        await self.refresh_runner_status()
+                await self.process_jobs()
+            except Exception as e:
+                logging.exception(f"Scheduler pass failed: {e}")
 
-    def process_jobs(self):
-        jobs_waiting = self.job_storage.list_test_jobs_by_status("waiting")
-        if not jobs_waiting:
+    def _pool_key(self, runner_or_job: RunnerHandle | TestJob) -> str:
+        """空闲runner按这个键分组，目前只按操作系统，以后可以加上标签"""
+        return runner_or_job.os
+
+    def _idle_pools(self, exclude: set[str]) -> dict[str, deque[RunnerHandle]]:
+        """
+        空闲runner在前，正在执行但还能排队的runner在后，
+        排到忙碌runner上的任务会在当前任务执行时提前下载版本
+
+        exclude 中的runner(本轮已经拒绝过任务)不参与分配
+        """
+        pools: dict[str, deque[RunnerHandle]] = {}
+        for runner in self.runners:
+            if runner.status == "idle" and runner.id not in exclude:
+                pools.setdefault(self._pool_key(runner), deque()).append(runner)
+        for runner in self.runners:
+            if (
+                runner.status == "running"
+                and runner.queue_free > 0
+                and runner.id not in exclude
+            ):
+                pools.setdefault(self._pool_key(runner), deque()).append(runner)
+        return pools
+
+    def _take_runners(
+        self, pool: deque[RunnerHandle], job: TestJob, count: int
+    ) -> list[RunnerHandle]:
+        """
+        从 pool 中取出 count 个runner，空闲的优先，同样空闲时已经有任务版本的优先，
+        省去下载和解压
+        """
+        chosen = sorted(
+            pool,
+            key=lambda runner: (
+                runner.status != "idle",
+                job.rdscore_md5 not in runner.build_md5s,
+            ),
+        )[:count]
+        for runner in chosen:
+            pool.remove(runner)
+        return chosen
+
+    async def process_jobs(self) -> int:
+        """
+        一轮调度尽可能多地把等待中的任务分配给空闲runner，并发发送给runner
+
+        被拒绝的任务留在等待队列，拒绝它的runner不再参与本轮分配
+        返回成功分发的任务数
+        """
+        dispatched = 0
+        rejected: set[str] = set()
+        while True:
+            idle_pools = self._idle_pools(rejected)
+            if not idle_pools:
+                return dispatched
+            assignments = []
+            # 按出队顺序从堆中逐个取任务，空闲runner分完就停，不需要排序整个队列
+            with closing(self.waiting.iter_ordered()) as jobs_waiting:
+                for job in jobs_waiting:
+                    pool = idle_pools.get(self._pool_key(job))
+                    if not pool:
+                        continue
+                    # 允许分片的任务一次拿走多个空闲runner；只数真正空闲的，
+                    # 排到忙碌runner队列里的分片要等它当前的任务结束，反而拖慢整个任务
+                    idle_count = sum(1 for runner in pool if runner.status == "idle")
+                    shard_count = max(1, min(job.max_shards, idle_count))
+                    assignments.append(
+                        (job, self._take_runners(pool, job, shard_count))
+                    )
+                    if not any(idle_pools.values()):
+                        break
+            if not assignments:
+                return dispatched
+            results = await asyncio.gather(
+                *(
+                    self._dispatch(job, runners[0], rejected)
+                    if len(runners) == 1
+                    else self._dispatch_sharded(job, runners, rejected)
+                    for job, runners in assignments
+                )
+            )
+            # 每一轮至少有一个runner不再空闲，所以循环一定会结束
+            dispatched += sum(results)
+
+    async def _dispatch_sharded(
+        self, job: TestJob, runners: list[RunnerHandle], rejected: set[str]
+    ) -> bool:
+        """
+        按测试目录把任务拆成多个子任务，分别发给 runners
+
+        发送失败的子任务进入等待队列，之后由任意匹配的runner执行
+        """
+        try:
+            cases = await asyncio.to_thread(fetch_test_cases, runners[0])
+        except (requests.RequestException, ValueError) as e:
+            logging.error(f"Failed to list test cases on runner {runners[0].id}: {e!r}")
+            cases = []
+        job.case_durations = self.result_storage.get_case_durations(
+            job.os, job.testcase_mark
+        )
+        case_groups = split_cases(cases, len(runners), job.case_durations)
+        if len(case_groups) < 2:
+            return await self._dispatch(job, runners[0], rejected)
+        shards = make_shards(job, case_groups)
+        for shard in shards:
+            self.job_storage.add_test_job(shard)
+        job.status = "running"
+        job.shard_ids = [shard.id for shard in shards]
+        job.dispatch_time = datetime.datetime.now().isoformat()
+        if not self.job_storage.transition_test_job(job, "waiting"):
+            logging.error(f"Job {job.id} changed while sharding.")
+            self.waiting.remove(job.id)
             return False
-        for job in jobs_waiting:
-            if self.match_and_dispatch_job(job):
-                # remove job from jobs_to_dispatch
-                return True
-        return False
+        self.waiting.served(job.id)
+        self.event_hub.publish("job_updated", job)
+        logging.info(f"Job {job.id} split into {len(shards)} shards.")
+        results = await asyncio.gather(
+            *(
+                self._dispatch(shard, runner, rejected)
+                for shard, runner in zip(shards, runners)
+            )
+        )
+        for shard, ok in zip(shards, results):
+            if not ok:
+                self.waiting.push(shard)
+        return True
+
+    def _build_peers(self, job: TestJob, runner: RunnerHandle) -> list[str]:
+        """
+        已经有这个版本的其他runner，空闲的在前，同类中随机打乱分散下载压力
+
+        都下载失败时runner最后从dispatcher下载
+        """
+        if runner.build_md5s and job.rdscore_md5 in runner.build_md5s:
+            return []
+        peers = [
+            peer
+            for peer in self.runners
+            if peer.id != runner.id
+            and peer.status in ("idle", "running")
+            and job.rdscore_md5 in peer.build_md5s
+        ]
+        random.shuffle(peers)
+        peers.sort(key=lambda peer: peer.status != "idle")
+        return [
+            f"{peer.baseurl}/test/storage/builds/{job.rdscore_md5}.zip"
+            for peer in peers[: CONFIG.build_peer_count]
+        ]
+
+    async def _dispatch(
+        self, job: TestJob, runner: RunnerHandle, rejected: set[str]
+    ) -> bool:
+        """拒绝任务的runner加入 rejected，本轮调度不再分配给它"""
+        job.rdscore_peer_urls = self._build_peers(job, runner)
+        # runner按这里给出的耗时从长到短执行测试目录
+        if not job.case_durations:
+            job.case_durations = self.result_storage.get_case_durations(
+                job.os, job.testcase_mark
+            )
+        if job.cases is not None:
+            job.case_durations = estimate_durations(job.cases, job.case_durations)
+        # 在下一次心跳之前不要再把任务分给这个runner
+        if runner.status == "running":
+            runner.queue_free -= 1
+        runner.status = "running"
+        try:
+            if not await asyncio.to_thread(accept_job, job, runner):
+                logging.info(f"Runner {runner.id} rejected job {job.id}.")
+                rejected.add(runner.id)
+                return False
+            res_json = await asyncio.to_thread(send_job, job, runner)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.error(f"Failed to dispatch job {job.id} to runner {runner.id}: {e!r}")
+            runner.status = "error"
+            return False
+        logging.info(f"Job {job.id} submitted to runner {runner.id}. Response: {res_json}")
+        job.runner_id = runner.id
+        job.status = "running"
+        job.dispatch_time = datetime.datetime.now().isoformat()
+        if not self.job_storage.transition_test_job(job, "waiting"):
+            logging.error(f"Job {job.id} changed while dispatching to runner {runner.id}.")
+            self.waiting.remove(job.id)
+            return False
+        self.waiting.served(job.id)
+        self.event_hub.publish("job_updated", job)
+        logging.info(f"Job {job.id} dispatched to runner {runner.id}.")
+        # runner status is managed by the runner itself
+        return True
+
+    async def refresh_running_jobs(self):
+        """
+        向runner查询正在运行的任务，结束的任务更新状态，
+        分片任务的所有子任务都结束后合并结果
+        """
+        runners = {runner.id: runner for runner in self.runners}
+        all_running = self.job_storage.list_test_jobs_by_status("running")
+        running = [job for job in all_running if job.runner_id in runners]
 
-    def match_and_dispatch_job(self, job: TestJob):
-        logging.info(f"Trying to match job {job.id} with available runners.")
-        for runner in self.runners[:]:
-            logging.info(f"Checking runner {runner.id} with status {runner.status} for job {job.id}.")
-            # match job and runner
-            if runner.os != job.os:
-                logging.info(f"Runner {runner.id} OS {runner.os} does not match job OS {job.os}.")
+        async def query(job: TestJob):
+            try:
+                return await asyncio.to_thread(
+                    fetch_runner_job, job, runners[job.runner_id]
+                )
+            except (requests.RequestException, ValueError) as e:
+                logging.error(f"Failed to query job {job.id}: {e!r}")
+                return None
+
+        results = await asyncio.gather(*(query(job) for job in running))
+        for job, runner_job in zip(running, results):
+            if runner_job is None:
                 continue
-            if runner.status != "idle":
-                logging.info(f"Runner {runner.id} is not idle, skipping.")
+            if runner_job.get("error") == "job not found":
+                runner_job = {"runner_status": "failed", "error": "job lost by runner"}
+            if runner_job.get("runner_status") not in ("finished", "failed"):
                 continue
-            if accept_job(job, runner):
-                res_json = send_job(job, runner)
-                logging.info(f"Job {job.id} submitted to runner {runner.id}. Response: {res_json}")
-                job.runner_id = runner.id
-                job.status = "running"
-                self.job_storage.update_test_job(job)
-                logging.info(f"Job {job.id} dispatched to runner {runner.id}.")
-                # runner status is managed by the runner itself
-                self.jobs_running.append(job)
-                return True
-            else:
-                logging.info(f"Runner {runner.id} rejected job {job.id}.")
-        return False
-    
-    def refresh_runner_status(self):
+            await self._complete_job(job, runners[job.runner_id], runner_job)
+        # 父任务没有runner，平时在最后一个子任务结束时合并；合并失败或者dispatcher
+        # 在合并前重启时，在这里重新检查
+        for job in all_running:
+            if job.shard_ids:
+                await self._merge_shards(job.id)
+
+    async def _complete_job(self, job: TestJob, runner: RunnerHandle, runner_job: dict):
+        job.status = runner_job["runner_status"]
+        job.error = runner_job.get("error")
+        job.tested_cases = runner_job.get("finished_cases", [])
+        job.report_url = f"{runner.baseurl}/files/{job.id}/merged.html"
+        job.finish_time = datetime.datetime.now().isoformat()
+        if not self.job_storage.transition_test_job(job, "running"):
+            return
+        self.event_hub.publish("job_updated", job)
+        if job.dispatch_time:
+            self.record_job_duration(
+                (
+                    datetime.datetime.fromisoformat(job.finish_time)
+                    - datetime.datetime.fromisoformat(job.dispatch_time)
+                ).total_seconds()
+            )
+        logging.info(f"Job {job.id} {job.status} on runner {runner.id}.")
+        if job.parent_id is not None:
+            await self._merge_shards(job.parent_id)
+
+    async def _merge_shards(self, parent_id: str):
+        parent = self.job_storage.get_test_job_by_id(parent_id)
+        if parent is None or parent.status != "running":
+            return
+        shards = [
+            self.job_storage.get_test_job_by_id(shard_id)
+            for shard_id in parent.shard_ids
+        ]
+        if any(
+            shard is None or shard.status not in ("finished", "failed")
+            for shard in shards
+        ):
+            return
+        merged = merge_shard_results(parent, shards)
+        try:
+            report_path = await asyncio.to_thread(merge_shard_reports, merged, shards)
+        except OSError as e:
+            # 报告合并失败不影响父任务结束，各子任务的报告仍然可以访问
+            logging.error(f"Failed to merge reports of job {parent.id}: {e!r}")
+            report_path = None
+        if report_path is not None:
+            merged.report_url = f"/api/jobs/{parent.id}/report"
+        if self.job_storage.transition_test_job(merged, "running"):
+            self.event_hub.publish("job_updated", merged)
+        logging.info(f"Job {parent.id} {merged.status}, merged {len(shards)} shards.")
+
+    async def refresh_runner_status(self):
         """
         和runner通信，更新runner状态
         /info
         """
+        previous = {runner.id: runner.status for runner in self.runners}
+        infos = await self.heartbeat.sweep(self.runners)
         for runner in self.runners:
-            try:
-                res = requests.get(f"{runner.baseurl}/info")
-                if res.status_code == 200:
-                    runner.status = "idle"
-                else:
-                    runner.status = "ping-failed"
-                runner_os = res.json()["os"]
-                if runner_os != runner.os:
-                    logging.warning(f"Runner {runner.id} OS {runner.os} does not match reported OS {runner_os}. Updating runner info.")
-                    runner.os = runner_os
-                    # update runner info file
-                    file_path = Path(CONFIG.runner_infos_path) / f"{runner.id}.json"
-                    if file_path.exists():
-                        with open(file_path, 'w') as f:
-                            f.write(runner.model_dump_json())
-
-            except requests.RequestException as e:
-                logging.error(f"Failed to ping runner {runner.id}: {e}")
-                runner.status = "error"        
+            info = infos.get(runner.id)
+            if info is None:
+                continue
+            if runner.status == "idle" and previous.get(runner.id) != "idle":
+                logging.info(f"Runner {runner.id} became idle.")
+            runner_os = info["os"]
+            if runner_os != runner.os:
+                logging.warning(f"Runner {runner.id} OS {runner.os} does not match reported OS {runner_os}. Updating runner info.")
+                runner.os = runner_os
+                # update runner info file
+                file_path = Path(CONFIG.runner_infos_path) / f"{runner.id}.json"
+                if file_path.exists():
+                    with open(file_path, 'w') as f:
+                        f.write(runner.model_dump_json())
 
     def get_jobs_to_dispatch(self) -> list[TestJob]:
         """
-        获取待分发的任务
+        获取待分发的任务，按出队顺序
+        """
+        return self.waiting.ordered()
+
+    def record_job_duration(self, duration_sec: float):
+        self.avg_job_duration_sec = (
+            0.8 * self.avg_job_duration_sec + 0.2 * duration_sec
+        )
+
+    def get_queue_position(self, job_id: str) -> QueuePosition | None:
+        """
+        任务在同操作系统等待任务中的位置，以及预计开始时间
+
+        预计开始时间 = 前面的任务按runner数分批，每批耗时取平均任务耗时
         """
-        return self.job_storage.list_test_jobs_by_status("waiting")
+        job = self.job_storage.get_test_job_by_id(job_id)
+        if job is None:
+            return None
+        if job.status != "waiting" or job_id not in self.waiting:
+            return QueuePosition(job_id=job_id, status=job.status)
+        same_os = [
+            j.id for j in self.waiting.ordered()
+            if self._pool_key(j) == self._pool_key(job)
+        ]
+        position = same_os.index(job_id)
+        runners = [
+            r for r in self.runners
+            if self._pool_key(r) == self._pool_key(job)
+            and r.status in ("idle", "running")
+        ]
+        idle = sum(1 for r in runners if r.status == "idle")
+        if position < idle:
+            waves = 0
+        else:
+            waves = (position - idle) // max(1, len(runners)) + 1
+        start = datetime.datetime.now() + datetime.timedelta(
+            seconds=waves * self.avg_job_duration_sec
+        )
+        return QueuePosition(
+            job_id=job_id,
+            status=job.status,
+            position=position,
+            estimated_start_time=start.isoformat(timespec="seconds"),
+        )
     
     def get_running_jobs(self) -> list[TestJob]:
         """
@@ -0,0 +1,145 @@
+"""
+分片执行
+
+1. 把一个测试任务的测试目录分成多组，每组作为一个子任务发给一个runner
+2. 所有子任务结束后，合并执行过的目录和测试报告到父任务
+"""
+
+import datetime
+import heapq
+import logging
+import os
+import subprocess
+from pathlib import Path
+
+import requests
+
+from dispatcher.config import CONFIG
+from dispatcher.types import TestJob
+
+REPORT_DOWNLOAD_TIMEOUT_SEC = 60
+
+
+# 没有任何历史耗时时每个测试目录的估计耗时，只影响相对大小
+DEFAULT_CASE_DURATION_SEC = 60.0
+
+
+def estimate_durations(cases: list[str], durations: dict[str, float]) -> dict[str, float]:
+    """
+    没有历史记录的目录按已知耗时的中位数估计
+
+    runner执行时对没有估计值的目录(比如dispatcher不知道的新目录)也按同样的方法估计
+    """
+    known = sorted(durations[case] for case in cases if case in durations)
+    default = known[len(known) // 2] if known else DEFAULT_CASE_DURATION_SEC
+    return {case: durations.get(case, default) for case in cases}
+
+
+def split_cases(
+    cases: list[str], shard_count: int, durations: dict[str, float] | None = None
+) -> list[list[str]]:
+    """
+    按历史耗时把测试目录分成负载均衡的组(LPT)，空的组会被去掉
+
+    从耗时最长的目录开始，每次放进当前总耗时最短的组，组内也按耗时从长到短排列
+    """
+    estimated = estimate_durations(cases, durations or {})
+    groups: list[list[str]] = [[] for _ in range(shard_count)]
+    loads = [(0.0, i) for i in range(shard_count)]
+    for case in sorted(cases, key=lambda case: -estimated[case]):
+        load, i = heapq.heappop(loads)
+        groups[i].append(case)
+        heapq.heappush(loads, (load + estimated[case], i))
+    return [group for group in groups if group]
+
+
+def make_shards(job: TestJob, case_groups: list[list[str]]) -> list[TestJob]:
+    return [
+        TestJob(
+            id=f"{job.id}-shard{i}",
+            runner_id="",
+            os=job.os,
+            testcase_mark=job.testcase_mark,
+            rdscore_version=job.rdscore_version,
+            status="waiting",
+            start_time=job.start_time,
+            priority=job.priority,
+            submitter=job.submitter,
+            parent_id=job.id,
+            cases=cases,
+            rdscore_file_url=job.rdscore_file_url,
+            rdscore_md5=job.rdscore_md5,
+            events_url=job.events_url,
+            case_durations=estimate_durations(cases, job.case_durations),
+        )
+        for i, cases in enumerate(case_groups)
+    ]
+
+
+def merge_shard_results(parent: TestJob, shards: list[TestJob]) -> TestJob:
+    """合并子任务的状态和执行过的目录，任一子任务失败则父任务失败"""
+    merged = parent.model_copy(deep=True)
+    merged.tested_cases = sorted(
+        case for shard in shards for case in shard.tested_cases
+    )
+    errors = [
+        f"{shard.id}: {shard.error}"
+        for shard in shards
+        if shard.status == "failed"
+    ]
+    merged.status = "failed" if errors else "finished"
+    merged.error = "; ".join(errors) or None
+    merged.finish_time = datetime.datetime.now().isoformat()
+    return merged
+
+
+def report_dir(job_id: str) -> Path:
+    return Path(CONFIG.test_records_path) / job_id
+
+
+def merge_shard_reports(parent: TestJob, shards: list[TestJob]) -> Path | None:
+    """
+    下载每个子任务的合并报告，再合并成父任务的报告
+
+    没有配置 pytest_html_merger 时生成一个链接到各子任务报告的页面
+    """
+    output_dir = report_dir(parent.id)
+    shards_dir = output_dir / "shards"
+    os.makedirs(shards_dir, exist_ok=True)
+    downloaded = []
+    for shard in shards:
+        if not shard.report_url:
+            continue
+        try:
+            res = requests.get(shard.report_url, timeout=REPORT_DOWNLOAD_TIMEOUT_SEC)
+            res.raise_for_status()
+        except requests.RequestException as e:
+            logging.error(f"failed to download report of {shard.id}: {e}")
+            continue
+        path = shards_dir / f"{shard.id}.html"
+        path.write_bytes(res.content)
+        downloaded.append(path)
+    merged_path = output_dir / "merged.html"
+    if CONFIG.pytest_html_merger and downloaded:
+        ret = subprocess.call(
+            [
+                CONFIG.pytest_html_merger,
+                "-i",
+                str(shards_dir),
+                "-o",
+                str(merged_path),
+            ]
+        )
+        if ret == 0:
+            return merged_path
+        logging.error(f"pytest_html_merger failed for {parent.id}: {ret}")
+    links = "\n".join(
+        f'<li><a href="{shard.report_url}">{shard.id}</a> {shard.status}</li>'
+        for shard in shards
+        if shard.report_url
+    )
+    merged_path.write_text(
+        f"<html><body><h1>{parent.id}</h1><ul>\n{links}\n</ul></body></html>",
+        encoding="utf-8",
+    )
+    return merged_path
@@ -4,13 +4,22 @@
 2. 对应的测试记录
 """
 
+from abc import ABC, abstractmethod
+import bisect
 import datetime
 import hashlib
+import json
 import logging
 from pathlib import Path
-from dispatcher.types import RDSCoreVersion, TestJob
+from dispatcher.types import RDSCoreVersion, TestCaseResult, TestJob, TestResultRecord
 from dispatcher.config import CONFIG
 import os
+import sqlite3
+import threading
+import uuid
+from collections.abc import AsyncIterator
+
+import aiofiles
 
 # possible filename formats:
 # windows-0.2.0.240909-0.2.0.zip
@@ -48,20 +57,53 @@ def parse_rdscore_version_from_filename(filename: str) -> RDSCoreVersion | None:
         os=os,
         md5="",  # MD5 can be calculated later
         name=name,
+        build_date=parse_build_date_from_filename(filename),
     )
 
 
-def parse_rdscore_version(path: Path) -> RDSCoreVersion | None:
+def parse_build_date_from_filename(filename: str) -> str:
+    """
+    从文件名中解析构建日期
+
+    windows-0.2.0.250707-0620.zip -> 2025-07-07T06:20:00
+    windows-0.2.0.250707.zip -> 2025-07-07T00:00:00
+    解析失败返回空字符串
+    """
+    segments = filename.replace(".zip", "").split("-")
+    if len(segments) < 2:
+        return ""
+    version_segments = segments[1].split(".")
+    if len(version_segments) < 4:
+        return ""
+    date_str = version_segments[3]
+    if len(segments) > 2 and len(segments[2]) == 4 and segments[2].isdigit():
+        date_str += segments[2]
+    else:
+        date_str += "0000"
+    try:
+        return datetime.datetime.strptime(date_str, "%y%m%d%H%M").isoformat()
+    except ValueError:
+        return ""
+
+
+def version_sort_key(version: RDSCoreVersion) -> tuple[str, str]:
+    """按文件名中的构建日期排序，没有构建日期的按上传时间"""
+    return version.build_date or version.date, version.date
+
+
+def parse_rdscore_version(path: Path, md5: str | None = None) -> RDSCoreVersion | None:
     logging.info(f"parse_rdscore_version: {path}")
     if not path.exists():
         logging.error(f"file {path} does not exist")
         return None
-    # calculate md5 of the file
-    md5 = hashlib.md5(path.read_bytes()).hexdigest()
     version = parse_rdscore_version_from_filename(path.name)
     logging.info(f"parse_rdscore_version_from_filename: {version}")
     if version is None:
         return None
+    if md5 is None:
+        # calculate md5 of the file, chunk by chunk
+        with open(path, "rb") as f:
+            md5 = hashlib.file_digest(f, "md5").hexdigest()
     version.md5 = md5
     # version.date is iso8601 date, we can use the file modification time
     # as the date
@@ -75,14 +117,52 @@ def parse_rdscore_version(path: Path) -> RDSCoreVersion | None:
 
 
 class VersionStorage:
+    # 版本目录下的元数据索引，按 (文件名, 大小, mtime) 缓存解析结果和md5
+    INDEX_FILENAME = ".index.json"
+
     def __init__(self):
+        # 按 version_sort_key 从旧到新排列
         self.rdscore_versions: list[RDSCoreVersion] = []
+        self._by_name: dict[str, RDSCoreVersion] = {}
+        self._by_os_name: dict[tuple[str, str], RDSCoreVersion] = {}
+        # version_prefix -> 按 version_sort_key 从旧到新排列的版本
+        self._by_prefix: dict[str, list[RDSCoreVersion]] = {}
         self.test_records: list[TestJob] = []
+        # filename -> {"size": int, "mtime": float, "version": dict}
+        self._index: dict[str, dict] = {}
+        # name -> 最近一次被下载或提交任务的时间(epoch)，没有记录时按文件的修改时间
+        self._last_used: dict[str, float] = {}
         os.makedirs(CONFIG.rdscore_versions_path, exist_ok=True)
         self._load_rdscore_versions()
 
+    def _index_path(self) -> Path:
+        return Path(CONFIG.rdscore_versions_path) / self.INDEX_FILENAME
+
+    def _read_index(self) -> dict[str, dict]:
+        path = self._index_path()
+        if not path.exists():
+            return {}
+        try:
+            return json.loads(path.read_text())
+        except Exception as e:
+            logging.error(f"failed to read version index {path}: {e}")
+            return {}
+
+    def _write_index(self):
+        path = self._index_path()
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self._index, indent=4))
+        os.replace(tmp_path, path)
+
+    def _index_entry(self, path: Path, version: RDSCoreVersion) -> dict:
+        stat = path.stat()
+        return {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "version": version.model_dump(),
+        }
+
     def _load_rdscore_versions(self):
-        self.rdscore_versions.clear()
         logging.info(f"load rdscore versions from {CONFIG.rdscore_versions_path}")
         if not Path(CONFIG.rdscore_versions_path).exists():
             logging.info(f"rdscore versions path {CONFIG.rdscore_versions_path} does not exist")
@@ -90,32 +170,103 @@ class VersionStorage:
         if not Path(CONFIG.rdscore_versions_path).is_dir():
             logging.error(f"rdscore versions path {CONFIG.rdscore_versions_path} is not a directory")
             return
-        # 从文件夹中扫描rdscore版本
+        cached = self._read_index()
+        index = {}
+        versions = []
+        # 从文件夹中扫描rdscore版本，只有新增或变化的文件才重新计算md5
         for path in Path(CONFIG.rdscore_versions_path).iterdir():
-            version = parse_rdscore_version(path)
+            if path.name.startswith("."):
+                continue
+            stat = path.stat()
+            entry = cached.get(path.name)
+            if (
+                entry is not None
+                and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime
+            ):
+                version = RDSCoreVersion.model_validate(entry["version"])
+            else:
+                version = parse_rdscore_version(path)
+                if version is not None:
+                    entry = self._index_entry(path, version)
             if version is not None:
-                self.rdscore_versions.append(version)
+                versions.append(version)
+                index[path.name] = entry
             else:
                 logging.warning(f"file {path} is not a valid rdscore zip file")
+        self._index = index
+        self._rebuild_catalog(versions)
+        if index != cached:
+            self._write_index()
 
-    def add_rdscore_version(self, version: str):
-        self.rdscore_versions.append(version)
+    def _add_catalog_entry(self, path: Path, md5: str) -> RDSCoreVersion | None:
+        """上传完成后只把这一个文件加入目录，不重新扫描整个文件夹"""
+        version = parse_rdscore_version(path, md5)
+        if version is None:
+            return None
+        self._index[path.name] = self._index_entry(path, version)
+        self._write_index()
+        self.add_rdscore_version(version)
+        return version
 
-    def add_rdscore_zip(self, zip_file: bytes, filename: str, expected_md5: str):
-        # 检查md5
-        md5 = hashlib.md5(zip_file).hexdigest()
-        logging.info(f"md5: {md5}, expected_md5: {expected_md5}")
-        if md5 != expected_md5:
-            logging.error(f"md5 not match, {md5} != {expected_md5}")
-            return
-        # 保存
-        path = Path(CONFIG.rdscore_versions_path) / filename
-        logging.info(f"save rdscore zip to {path}")
-        path.write_bytes(zip_file)
-        logging.info(f"save rdscore zip to {path} done")
+    def _rebuild_catalog(self, versions: list[RDSCoreVersion]):
+        self.rdscore_versions = sorted(versions, key=version_sort_key)
+        self._by_name = {v.name: v for v in self.rdscore_versions}
+        self._by_os_name = {(v.os, v.name): v for v in self.rdscore_versions}
+        self._by_prefix = {}
+        for v in self.rdscore_versions:
+            self._by_prefix.setdefault(v.version_prefix, []).append(v)
+
+    def add_rdscore_version(self, version: RDSCoreVersion):
+        old = self._by_name.get(version.name)
+        if old is not None:
+            self.rdscore_versions.remove(old)
+            self._by_prefix[old.version_prefix].remove(old)
+        bisect.insort(self.rdscore_versions, version, key=version_sort_key)
+        bisect.insort(
+            self._by_prefix.setdefault(version.version_prefix, []),
+            version,
+            key=version_sort_key,
+        )
+        self._by_name[version.name] = version
+        self._by_os_name[(version.os, version.name)] = version
+
+    async def save_rdscore_stream(
+        self, chunks: AsyncIterator[bytes], filename: str, expected_md5: str
+    ) -> RDSCoreVersion | None:
+        """
+        边接收边写临时文件并计算md5，md5一致才重命名到版本目录
+
+        内存占用只和分块大小有关，与zip大小无关
+        """
+        filename = Path(filename).name
+        if parse_rdscore_version_from_filename(filename) is None:
+            logging.error(f"invalid rdscore zip filename {filename}")
+            return None
+        versions_path = Path(CONFIG.rdscore_versions_path)
+        tmp_path = versions_path / f".upload-{uuid.uuid4().hex}"
+        md5 = hashlib.md5()
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    md5.update(chunk)
+                    await f.write(chunk)
+            logging.info(
+                f"md5: {md5.hexdigest()}, expected_md5: {expected_md5}"
+            )
+            if md5.hexdigest() != expected_md5:
+                logging.error(f"md5 not match, {md5.hexdigest()} != {expected_md5}")
+                return None
+            path = versions_path / filename
+            os.replace(tmp_path, path)
+            logging.info(f"save rdscore zip to {path} done")
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
         # 更新rdscore_versions
-        self._load_rdscore_versions()
+        version = self._add_catalog_entry(path, md5.hexdigest())
         logging.info(f"add rdscore version {filename} done")
+        return version
 
     def add_test_record(self, test_record: TestJob):
         self.test_records.append(test_record)
@@ -132,12 +283,7 @@ class VersionStorage:
         return self.rdscore_versions
 
     def fetch_file_and_md5_of_version(self, version_str: str, os: str):
-        # find version in rdscore_versions
-        version = None
-        for v in self.rdscore_versions:
-            if v.full == version_str and v.os == os:
-                version = v
-                break
+        version = self._by_os_name.get((os, version_str))
         if version is None:
             return None
 
@@ -145,78 +291,468 @@ class VersionStorage:
         if not path.exists():
             return None
         return path.read_bytes(), version.md5
-    
+
     def get_version_info(self, version_str: str) -> RDSCoreVersion | None:
-        for version in self.rdscore_versions:
-            if version.name == version_str:
+        return self._by_name.get(version_str)
+
+    def touch(self, version_str: str):
+        """记录版本被使用，磁盘配额按最近使用时间淘汰"""
+        self._last_used[version_str] = datetime.datetime.now().timestamp()
+
+    def remove_rdscore_version(self, version: RDSCoreVersion):
+        path = Path(CONFIG.rdscore_versions_path) / f"{version.name}.zip"
+        if path.exists():
+            path.unlink()
+        self._index.pop(path.name, None)
+        self._write_index()
+        self._rebuild_catalog(
+            [v for v in self.rdscore_versions if v.name != version.name]
+        )
+        self._last_used.pop(version.name, None)
+        logging.info(f"removed rdscore version {version.name}")
+
+    def enforce_budget(self, budget_bytes: int, protected: set[str]) -> list[RDSCoreVersion]:
+        """
+        总大小超过 budget_bytes 时按最近使用时间删除版本，返回删除的版本
+
+        protected 中的版本和每个 (os, version_prefix) 最新的版本不会被删除
+        """
+        sizes = {
+            v.name: self._index.get(f"{v.name}.zip", {}).get("size", 0)
+            for v in self.rdscore_versions
+        }
+        total = sum(sizes.values())
+        if total <= budget_bytes:
+            return []
+        latest = {
+            (v.os, v.version_prefix): v.name for v in self.rdscore_versions
+        }
+        candidates = [
+            v
+            for v in self.rdscore_versions
+            if v.name not in protected and v.name not in latest.values()
+        ]
+        candidates.sort(
+            key=lambda v: self._last_used.get(
+                v.name, self._index.get(f"{v.name}.zip", {}).get("mtime", 0)
+            )
+        )
+        removed = []
+        for version in candidates:
+            if total <= budget_bytes:
+                break
+            self.remove_rdscore_version(version)
+            total -= sizes[version.name]
+            removed.append(version)
+        return removed
+
+    def get_latest_version(self, version_prefix: str, os: str) -> RDSCoreVersion | None:
+        """某个 version_prefix 下指定操作系统最新的构建"""
+        for version in reversed(self._by_prefix.get(version_prefix, [])):
+            if version.os == os:
                 return version
         return None
-    
+
+class JobBackend(ABC):
+    """
+    测试任务的存储后端
+
+    TestJobStorage 通过这个接口读写任务，方便替换成其他存储
+    """
+
+    @abstractmethod
+    def add(self, test_job: TestJob):
+        pass
+
+    def add_many(self, test_jobs: list[TestJob]):
+        """批量导入，已经存在的任务不覆盖；后端支持事务时应该重写成一次提交"""
+        for test_job in test_jobs:
+            if self.get(test_job.id) is None:
+                self.add(test_job)
+
+    @abstractmethod
+    def get(self, id: str) -> TestJob | None:
+        pass
+
+    @abstractmethod
+    def update(self, test_job: TestJob) -> bool:
+        pass
+
+    @abstractmethod
+    def transition(self, test_job: TestJob, from_status: str) -> bool:
+        """只有当存储中的状态仍是 from_status 时才写入 test_job"""
+
+    @abstractmethod
+    def list_all(self) -> list[TestJob]:
+        pass
+
+    @abstractmethod
+    def list_by(self, field: str, value: str) -> list[TestJob]:
+        pass
+
+
+class SqliteJobBackend(JobBackend):
+    """
+    嵌入式sqlite(WAL模式)存储，按id, status, runner_id, os, rdscore_version, cache_key建索引
+
+    调度线程和web线程共用一个连接，用锁串行化
+    """
+
+    INDEXED_FIELDS = ("status", "runner_id", "os", "rdscore_version", "cache_key")
+
+    def __init__(self, db_path: str):
+        os.makedirs(Path(db_path).parent, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                runner_id TEXT,
+                os TEXT,
+                rdscore_version TEXT,
+                start_time TEXT,
+                data TEXT NOT NULL,
+                cache_key TEXT
+            )
+            """
+        )
+        for field in self.INDEXED_FIELDS:
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_jobs_{field} "
+                f"ON jobs ({field}, start_time)"
+            )
+
+    @staticmethod
+    def _row(test_job: TestJob) -> tuple:
+        return (
+            test_job.status,
+            test_job.runner_id,
+            test_job.os,
+            test_job.rdscore_version,
+            test_job.start_time,
+            test_job.model_dump_json(),
+            test_job.cache_key,
+            test_job.id,
+        )
+
+    def add(self, test_job: TestJob):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (status, runner_id, os, "
+                "rdscore_version, start_time, data, cache_key, id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._row(test_job),
+            )
+
+    def add_many(self, test_jobs: list[TestJob]):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO jobs (status, runner_id, os, "
+                    "rdscore_version, start_time, data, cache_key, id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [self._row(job) for job in test_jobs],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, id: str) -> TestJob | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM jobs WHERE id = ?", (id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return TestJob.model_validate_json(row[0])
+
+    def update(self, test_job: TestJob) -> bool:
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = ?, runner_id = ?, os = ?, "
+                "rdscore_version = ?, start_time = ?, data = ?, cache_key = ? "
+                "WHERE id = ?",
+                self._row(test_job),
+            )
+        return cur.rowcount == 1
+
+    def transition(self, test_job: TestJob, from_status: str) -> bool:
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = ?, runner_id = ?, os = ?, "
+                "rdscore_version = ?, start_time = ?, data = ?, cache_key = ? "
+                "WHERE id = ? AND status = ?",
+                self._row(test_job) + (from_status,),
+            )
+        return cur.rowcount == 1
+
+    def list_all(self) -> list[TestJob]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM jobs ORDER BY start_time"
+            ).fetchall()
+        return [TestJob.model_validate_json(row[0]) for row in rows]
+
+    def list_by(self, field: str, value: str) -> list[TestJob]:
+        if field not in self.INDEXED_FIELDS:
+            raise ValueError(f"field {field} is not indexed")
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT data FROM jobs WHERE {field} = ? ORDER BY start_time",
+                (value,),
+            ).fetchall()
+        return [TestJob.model_validate_json(row[0]) for row in rows]
+
+
 class TestJobStorage:
-    def __init__(self):
-        self.test_jobs: list[TestJob] = []
-        os.makedirs(CONFIG.jobs_path, exist_ok=True)
-        self._load_test_jobs()
-
-    def _load_test_jobs(self):
-        self.test_jobs.clear()
-        logging.info(f"load test jobs from {CONFIG.jobs_path}")
-        if not Path(CONFIG.jobs_path).exists():
-            logging.info(f"test jobs path {CONFIG.jobs_path} does not exist")
+    MIGRATED_MARKER = ".migrated"
+
+    def __init__(self, backend: JobBackend | None = None):
+        if backend is None:
+            backend = SqliteJobBackend(CONFIG.jobs_db_path)
+        self.backend = backend
+        self._migrate_json_jobs()
+
+    def _migrate_json_jobs(self):
+        """把旧版本按 {id}.json 保存的任务一次性导入后端"""
+        jobs_path = Path(CONFIG.jobs_path)
+        if not jobs_path.is_dir():
             return
-        if not Path(CONFIG.jobs_path).is_dir():
-            logging.error(f"test jobs path {CONFIG.jobs_path} is not a directory")
+        marker = jobs_path / self.MIGRATED_MARKER
+        if marker.exists():
             return
-        # 从文件夹中扫描测试记录
-        for path in Path(CONFIG.jobs_path).iterdir():
-            if path.suffix == ".json":
-                try:
-                    with open(path) as f:
-                        record = TestJob.model_validate_json(f.read())
-                        self.test_jobs.append(record)
-                except Exception as e:
-                    logging.error(f"failed to load test job {path}: {e}")
-    
+        logging.info(f"migrate test jobs from {jobs_path}")
+        test_jobs = []
+        for path in jobs_path.iterdir():
+            if path.suffix != ".json":
+                continue
+            try:
+                test_jobs.append(TestJob.model_validate_json(path.read_text()))
+            except Exception as e:
+                logging.error(f"failed to load test job {path}: {e}")
+        self.backend.add_many(test_jobs)
+        marker.write_text(datetime.datetime.now().isoformat())
+        logging.info(f"migrated {len(test_jobs)} test jobs")
+
     def add_test_job(self, test_job: TestJob):
-        self.test_jobs.append(test_job)
-        # save to file
-        path = Path(CONFIG.jobs_path) / f"{test_job.id}.json"
-        with open(path, "w") as f:
-            f.write(test_job.model_dump_json(indent=4))
-        logging.info(f"saved test job {test_job.id} to {path}")
+        self.backend.add(test_job)
+        logging.info(f"saved test job {test_job.id}")
 
     def get_test_job(self, id: str) -> TestJob | None:
-        for job in self.test_jobs:
-            if job.id == id:
-                return job
-        return None
-    
+        return self.backend.get(id)
+
     def list_test_jobs(self) -> list[TestJob]:
-        return self.test_jobs
-    
+        return self.backend.list_all()
+
     def list_test_jobs_by_runner(self, runner_id: str) -> list[TestJob]:
-        return [job for job in self.test_jobs if job.runner_id == runner_id]
-    
+        return self.backend.list_by("runner_id", runner_id)
+
     def list_test_jobs_by_os(self, os: str) -> list[TestJob]:
-        return [job for job in self.test_jobs if job.os == os]
-    
+        return self.backend.list_by("os", os)
+
     def list_test_jobs_by_status(self, status: str) -> list[TestJob]:
-        return [job for job in self.test_jobs if job.status == status]
-    
+        return self.backend.list_by("status", status)
+
+    def list_test_jobs_by_version(self, rdscore_version: str) -> list[TestJob]:
+        return self.backend.list_by("rdscore_version", rdscore_version)
+
+    def list_test_jobs_by_cache_key(self, cache_key: str) -> list[TestJob]:
+        return self.backend.list_by("cache_key", cache_key)
+
     def update_test_job(self, test_job: TestJob):
-        for i, job in enumerate(self.test_jobs):
-            if job.id == test_job.id:
-                self.test_jobs[i] = test_job
-                # save to file
-                path = Path(CONFIG.jobs_path) / f"{test_job.id}.json"
-                with open(path, "w") as f:
-                    f.write(test_job.model_dump_json(indent=4))
-                logging.info(f"updated test job {test_job.id} to {path}")
-                return
+        if self.backend.update(test_job):
+            logging.info(f"updated test job {test_job.id}")
+            return
         logging.error(f"test job {test_job.id} not found")
 
+    def transition_test_job(self, test_job: TestJob, from_status: str) -> bool:
+        """
+        原子地改变任务状态
+
+        只有存储中的任务仍处于 from_status 时才写入，避免两个线程同时改同一个任务
+        """
+        if self.backend.transition(test_job, from_status):
+            logging.info(
+                f"test job {test_job.id}: {from_status} -> {test_job.status}"
+            )
+            return True
+        logging.warning(
+            f"test job {test_job.id} is no longer {from_status}, "
+            f"skip transition to {test_job.status}"
+        )
+        return False
+
     def get_test_job_by_id(self, id: str) -> TestJob | None:
-        for job in self.test_jobs:
-            if job.id == id:
-                return job
-        return None
\ No newline at end of file
+        return self.backend.get(id)
+
+
+class TestResultStorage:
+    """
+    每个测试的结果，来自runner解析的junit xml，以及每个测试目录的历史耗时
+
+    和任务存在同一个sqlite文件的 test_results 表中，
+    按版本、测试标记、测试id建索引，查询某个版本的失败或最慢的测试不需要打开报告
+    """
+
+    COLUMNS = (
+        "job_id",
+        "rdscore_version",
+        "os",
+        "testcase_mark",
+        "case_name",
+        "nodeid",
+        "outcome",
+        "duration_sec",
+        "message",
+        "finish_time",
+    )
+    # 测试目录耗时滑动平均中新样本的权重
+    CASE_DURATION_SMOOTHING = 0.3
+    FILTER_FIELDS = ("job_id", "rdscore_version", "os", "testcase_mark", "case_name", "nodeid", "outcome")
+
+    def __init__(self, db_path: str | None = None):
+        if db_path is None:
+            db_path = CONFIG.jobs_db_path
+        os.makedirs(Path(db_path).parent, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS test_results (
+                job_id TEXT NOT NULL,
+                rdscore_version TEXT NOT NULL,
+                os TEXT NOT NULL,
+                testcase_mark TEXT NOT NULL,
+                case_name TEXT NOT NULL,
+                nodeid TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                duration_sec REAL NOT NULL,
+                message TEXT,
+                finish_time TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS case_durations (
+                os TEXT NOT NULL,
+                testcase_mark TEXT NOT NULL,
+                case_name TEXT NOT NULL,
+                duration_sec REAL NOT NULL,
+                samples INTEGER NOT NULL,
+                PRIMARY KEY (os, testcase_mark, case_name)
+            )
+            """
+        )
+        for name, columns in (
+            ("job", "job_id, case_name"),
+            ("version", "rdscore_version, outcome"),
+            ("mark", "testcase_mark, duration_sec"),
+            ("nodeid", "nodeid, finish_time"),
+        ):
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_test_results_{name} "
+                f"ON test_results ({columns})"
+            )
+
+    def record_case_duration(self, job: TestJob, case: str, duration_sec: float):
+        """按操作系统和测试标记记录测试目录耗时的滑动平均"""
+        alpha = self.CASE_DURATION_SMOOTHING
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO case_durations "
+                "(os, testcase_mark, case_name, duration_sec, samples) "
+                "VALUES (?, ?, ?, ?, 1) "
+                "ON CONFLICT (os, testcase_mark, case_name) DO UPDATE SET "
+                "duration_sec = ? * excluded.duration_sec + ? * duration_sec, "
+                "samples = samples + 1",
+                (job.os, job.testcase_mark, case, duration_sec, alpha, 1 - alpha),
+            )
+
+    def get_case_durations(self, os: str, testcase_mark: str) -> dict[str, float]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT case_name, duration_sec FROM case_durations "
+                "WHERE os = ? AND testcase_mark = ?",
+                (os, testcase_mark),
+            ).fetchall()
+        return dict(rows)
+
+    def add_case_results(self, job: TestJob, case: str, tests: list[TestCaseResult]):
+        """
+        同一个任务的测试目录重新执行时覆盖之前的结果，
+        分片任务的结果记在父任务下
+        """
+        job_id = job.parent_id or job.id
+        finish_time = datetime.datetime.now().isoformat()
+        rows = [
+            (
+                job_id,
+                job.rdscore_version,
+                job.os,
+                job.testcase_mark,
+                case,
+                test.nodeid,
+                test.outcome,
+                test.duration_sec,
+                test.message,
+                finish_time,
+            )
+            for test in tests
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM test_results WHERE job_id = ? AND case_name = ?",
+                    (job_id, case),
+                )
+                self._conn.executemany(
+                    f"INSERT INTO test_results ({', '.join(self.COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def query(
+        self,
+        filters: dict[str, str],
+        order_by: str = "finish_time",
+        limit: int = 100,
+    ) -> list[TestResultRecord]:
+        """
+        filters 的键必须是 FILTER_FIELDS 之一
+        order_by 为 duration_sec 时按耗时从长到短，否则按完成时间从新到旧
+        """
+        for field in filters:
+            if field not in self.FILTER_FIELDS:
+                raise ValueError(f"cannot filter test results by {field}")
+        where = " AND ".join(f"{field} = ?" for field in filters) or "1"
+        order = "duration_sec DESC" if order_by == "duration_sec" else "finish_time DESC"
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM test_results "
+                f"WHERE {where} ORDER BY {order} LIMIT ?",
+                (*filters.values(), limit),
+            ).fetchall()
+        records = []
+        for row in rows:
+            fields = dict(zip(self.COLUMNS, row, strict=True))
+            fields["case"] = fields.pop("case_name")
+            records.append(TestResultRecord(**fields))
+        return records
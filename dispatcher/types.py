@@ -7,13 +7,22 @@ class CreateTestJobRequest(BaseModel):
     rdscore_version: str = ""
     id: str | None = None
     os: str | None = None  # windows or linux
+    priority: int = 0  # larger runs earlier, -4 ~ 4
+    submitter: str = "anonymous"
+    max_shards: int = 1  # split the job across at most this many runners
+    # commit of the testcase repo, taken from the runners when not given
+    testcase_revision: str | None = None
+    # reuse the result of an identical job, or attach to it while it is still running
+    use_cache: bool = True
 
 
 class CreateTestJobResponse(BaseModel):
     created: bool = False
-    job_id: str | None = None
+    job_id: str | None = None  # the job that holds the result, may be an earlier job
     runner_id: str | None = None
     error: str | None = None
+    cached: bool = False  # an identical job already finished
+    attached: bool = False  # an identical job is waiting or running
 
 
 class RDSCoreVersion(BaseModel):
@@ -22,6 +31,7 @@ class RDSCoreVersion(BaseModel):
     name: str  # windows-0.1.9.240909-0.1.9.zip
     date: str # iso8601 date, upload date
     version_prefix: str  # 0.1.9
+    build_date: str = ""  # iso8601 date parsed from the filename, 2024-09-09
 
 # status: the status of the job (waiting, running, finished, failed)
 class TestJob(BaseModel):
@@ -35,6 +45,64 @@ class TestJob(BaseModel):
     report_url: str | None = None
     tested_cases: list[str] = []
     start_time: str
+    priority: int = 0
+    submitter: str = "anonymous"
+    dispatch_time: str | None = None
+    finish_time: str | None = None
+    max_shards: int = 1
+    parent_id: str | None = None  # set on shards of a sharded job
+    cases: list[str] | None = None  # test directories to run, None means all
+    shard_ids: list[str] = []
+    rdscore_file_url: str = ""  # where the runner downloads the rdscore zip
+    rdscore_md5: str = ""
+    rdscore_peer_urls: list[str] = []  # runners holding the build, tried before rdscore_file_url
+    events_url: str = ""  # where the runner pushes events of this job
+    case_durations: dict[str, float] = {}  # historical seconds per test directory
+    testcase_revision: str = ""
+    # build md5, testcase_mark and testcase revision; empty when the job must not be shared
+    cache_key: str = ""
+
+
+class QueuePosition(BaseModel):
+    job_id: str
+    status: str
+    position: int | None = None  # 0 means next to dispatch among jobs of the same os
+    estimated_start_time: str | None = None  # iso8601
+
+
+class TestCaseResult(BaseModel):
+    nodeid: str
+    outcome: str  # passed, failed, error, skipped
+    duration_sec: float
+    message: str | None = None
+
+
+class TestResultRecord(BaseModel):
+    job_id: str
+    rdscore_version: str
+    os: str
+    testcase_mark: str
+    case: str  # test directory
+    nodeid: str
+    outcome: str
+    duration_sec: float
+    message: str | None = None
+    finish_time: str  # iso8601
+
+
+class RunnerEvent(BaseModel):
+    type: str  # job_started, case_started, case_finished, job_finished
+    job_id: str
+    time: str = ""  # iso8601
+    case: str | None = None
+    result: int | None = None  # pytest exit code of the case
+    duration_sec: float | None = None
+    status: str | None = None  # job status on job_finished
+    error: str | None = None
+    finished_cases: list[str] | None = None
+    report_url: str | None = None  # path on the runner
+    tests: list[TestCaseResult] | None = None  # per-test results on case_finished
+    runner_id: str | None = None  # filled in by the dispatcher
 
 
 class RdscoreVersionTestRecord(BaseModel):
@@ -47,3 +115,8 @@ class RunnerHandle(BaseModel):
     os: str | None = "windows"
     status: str | None = "idle" # idle, running, error, ping-failed
     baseurl: str | None = "http://127.0.0.1:10898"
+    rtt_ms: float | None = None  # round trip time of the last heartbeat
+    last_heartbeat: str | None = None  # iso8601 time of the last heartbeat
+    queue_free: int = 0  # how many more jobs a busy runner can queue
+    testcase_revision: str = ""  # commit of the testcase repo on the runner
+    build_md5s: list[str] = []  # builds already extracted on the runner
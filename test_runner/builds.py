@@ -0,0 +1,247 @@
+"""
+rdscore版本的下载和解压，按md5内容寻址
+
+builds_dir/cas/{md5}.zip   下载或上传的版本
+builds_dir/cas/{md5}/      解压后的目录，每个版本只解压一次，
+                           其中的 .md5 记录md5，.name 记录版本名称
+builds_dir/slots/slot{i}/  第 i 个core实例的工作目录，二进制文件从解压目录硬链接，
+                           其他文件复制一份，core写文件不影响解压目录
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+from collections.abc import Iterable
+from pathlib import Path
+
+import requests
+from pydantic import BaseModel
+
+from test_runner.utils import dir_size
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT_SEC = (10, 60)  # connect, read
+# 从其他runner下载时连接超时更短，连不上就尽快换下一个来源
+PEER_DOWNLOAD_TIMEOUT_SEC = (3, 30)
+MD5_MARKER = ".md5"
+NAME_MARKER = ".name"
+MARKERS = (MD5_MARKER, NAME_MARKER)
+
+
+def file_md5(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "md5").hexdigest()
+
+
+def extract_zip(zip_path: Path, dest: Path):
+    """解压并保留zip中记录的文件权限，rbk需要可执行权限"""
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            extracted = zf.extract(info, dest)
+            mode = info.external_attr >> 16
+            if mode and not info.is_dir():
+                os.chmod(extracted, mode & 0o7777)
+
+
+def core_root(extracted: Path) -> Path:
+    """zip里只有一个顶层目录时，core在这个目录里"""
+    children = [p for p in extracted.iterdir() if p.name not in MARKERS]
+    if len(children) == 1 and children[0].is_dir():
+        return children[0]
+    return extracted
+
+
+def link_tree(
+    src: str,
+    dst: str,
+    copy_dirs: Iterable[str] = (),
+    link_suffixes: Iterable[str] = (),
+):
+    """
+    生成 src 的工作副本，只有只读的二进制文件硬链接，其他文件复制
+
+    硬链接的文件和 src 共用内容，core写这些文件会改到 src 和所有其他副本，
+    所以只链接后缀在 link_suffixes 中的文件(以及非windows上有可执行权限的文件)，
+    copy_dirs(相对路径)下的文件总是复制；不能硬链接(跨文件系统)时退回复制
+    """
+    copy_dirs = [os.path.normpath(d) for d in copy_dirs]
+    link_suffixes = tuple(suffix.lower() for suffix in link_suffixes)
+
+    def should_link(src_file: str) -> bool:
+        rel_path = os.path.relpath(src_file, src)
+        if any(rel_path == d or rel_path.startswith(d + os.sep) for d in copy_dirs):
+            return False
+        name = os.path.basename(src_file).lower()
+        # libfoo.so.1 这样带版本号的动态库
+        if name.endswith(link_suffixes) or ".so." in name:
+            return True
+        return os.name != "nt" and os.access(src_file, os.X_OK)
+
+    def link_or_copy(src_file: str, dst_file: str) -> str:
+        if should_link(src_file):
+            try:
+                os.link(src_file, dst_file)
+                return dst_file
+            except OSError:
+                pass
+        return shutil.copy2(src_file, dst_file)
+
+    shutil.copytree(src, dst, symlinks=True, copy_function=link_or_copy)
+
+
+class BuildInfo(BaseModel):
+    name: str
+    md5: str
+    last_used: float  # epoch seconds
+    size_bytes: int  # extracted directory and zip
+
+
+class BuildStore:
+    def __init__(self, builds_dir: str):
+        self.builds_dir = Path(builds_dir)
+        self.cas_dir = self.builds_dir / "cas"
+        os.makedirs(self.cas_dir, exist_ok=True)
+        self._locks: dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        # 已经解压好的版本，/info 上报给dispatcher
+        self._available: set[str] = {
+            entry.name
+            for entry in self.cas_dir.iterdir()
+            if (entry / MD5_MARKER).exists()
+        }
+
+    def _lock_for(self, md5: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(md5, threading.Lock())
+
+    def has(self, md5: str) -> bool:
+        return md5 in self._available
+
+    def available_md5s(self) -> list[str]:
+        return sorted(self._available)
+
+    def zip_path(self, md5: str) -> Path | None:
+        path = self.cas_dir / f"{md5}.zip"
+        return path if path.exists() else None
+
+    def ensure(self, urls: list[str], md5: str, name: str) -> str:
+        """
+        保证版本已经下载、校验并解压，返回core所在的目录(只读，不要直接在里面运行core)
+
+        urls 依次尝试，前面是已经有这个版本的其他runner，最后一个是dispatcher；
+        同一个版本同时只会下载一次，已经解压过的直接返回
+        """
+        with self._lock_for(md5):
+            target = self.cas_dir / md5
+            marker = target / MD5_MARKER
+            if marker.exists() and marker.read_text() == md5:
+                # marker的修改时间就是最近使用时间，磁盘配额按它淘汰
+                marker.touch()
+                return str(core_root(target))
+            zip_path = self.cas_dir / f"{md5}.zip"
+            if not zip_path.exists() or file_md5(zip_path) != md5:
+                self._download_any(urls, md5, zip_path)
+            return self._extract(zip_path, md5, name)
+
+    def upload_path(self) -> Path:
+        """上传的zip先写到这个临时文件，和cas在同一个文件系统上"""
+        return self.cas_dir / f".upload-{uuid.uuid4().hex}"
+
+    def add_zip(self, uploaded: Path, md5: str, name: str) -> str:
+        """把已经校验过md5的上传文件移动到cas中并解压，已经有这个版本时直接删除上传的文件"""
+        with self._lock_for(md5):
+            target = self.cas_dir / md5
+            if (target / MD5_MARKER).exists():
+                uploaded.unlink()
+                return str(core_root(target))
+            zip_path = self.cas_dir / f"{md5}.zip"
+            os.replace(uploaded, zip_path)
+            return self._extract(zip_path, md5, name)
+
+    def _extract(self, zip_path: Path, md5: str, name: str) -> str:
+        target = self.cas_dir / md5
+        tmp_dir = self.cas_dir / f".extract-{uuid.uuid4().hex}"
+        try:
+            extract_zip(zip_path, tmp_dir)
+            (tmp_dir / NAME_MARKER).write_text(name)
+            (tmp_dir / MD5_MARKER).write_text(md5)
+            if target.exists():
+                shutil.rmtree(target)
+            os.replace(tmp_dir, target)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._available.add(md5)
+        print(f"build {name} ({md5}) is ready in {target}")
+        return str(core_root(target))
+
+    def list_builds(self) -> list[BuildInfo]:
+        """已经解压的版本，按最近使用时间从旧到新"""
+        builds = []
+        for entry in self.cas_dir.iterdir():
+            marker = entry / MD5_MARKER
+            if not entry.is_dir() or not marker.exists():
+                continue
+            name_marker = entry / NAME_MARKER
+            zip_path = self.cas_dir / f"{entry.name}.zip"
+            builds.append(
+                BuildInfo(
+                    name=name_marker.read_text() if name_marker.exists() else "",
+                    md5=entry.name,
+                    last_used=marker.stat().st_mtime,
+                    size_bytes=dir_size(entry)
+                    + (zip_path.stat().st_size if zip_path.exists() else 0),
+                )
+            )
+        return sorted(builds, key=lambda build: build.last_used)
+
+    def remove(self, build: BuildInfo):
+        """删除解压目录和zip，和 ensure 使用同一把锁"""
+        with self._lock_for(build.md5):
+            self._available.discard(build.md5)
+            shutil.rmtree(self.cas_dir / build.md5, ignore_errors=True)
+            zip_path = self.cas_dir / f"{build.md5}.zip"
+            if zip_path.exists():
+                zip_path.unlink()
+        print(f"removed build {build.name} ({build.md5})")
+
+    def _save(self, chunks: Iterable[bytes], md5: str, zip_path: Path):
+        """边写临时文件边计算md5，一致才重命名"""
+        tmp_path = zip_path.with_name(f".download-{uuid.uuid4().hex}")
+        digest = hashlib.md5()
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+            if digest.hexdigest() != md5:
+                raise ValueError(f"md5 is {digest.hexdigest()}, expected {md5}")
+            os.replace(tmp_path, zip_path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def _download_any(self, urls: list[str], md5: str, zip_path: Path):
+        for i, url in enumerate(urls):
+            last = i == len(urls) - 1
+            try:
+                self._download(
+                    url,
+                    md5,
+                    zip_path,
+                    DOWNLOAD_TIMEOUT_SEC if last else PEER_DOWNLOAD_TIMEOUT_SEC,
+                )
+                return
+            except (requests.RequestException, ValueError) as e:
+                if last:
+                    raise
+                print(f"failed to download {url}: {e!r}, try next source")
+        raise ValueError(f"no source to download {md5}")
+
+    def _download(self, url: str, md5: str, zip_path: Path, timeout=DOWNLOAD_TIMEOUT_SEC):
+        print(f"download {url} to {zip_path}")
+        with requests.get(url, stream=True, timeout=timeout) as res:
+            res.raise_for_status()
+            self._save(res.iter_content(DOWNLOAD_CHUNK_SIZE), md5, zip_path)
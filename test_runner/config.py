@@ -7,8 +7,35 @@ class CiConfig(BaseModel):
     builds_dir: str 
     testcase_folder: str
     output_path: str
+    # 执行过的任务的索引(sqlite)，不要放在 output_path 下，那里的文件都会被 /files 公开
+    run_index_path: str
     pytest_path: str
     pytest_html_merger: str
+    # 同时运行的core实例数，每个实例一个端口和一份工作目录，测试目录在实例间并行执行
+    core_slots: int = 1
+    # 第 i 个core实例的端口是 core_base_port + i
+    core_base_port: int = 8088
+    # 正在执行任务时还能排队的任务数，排队任务的版本会提前下载解压
+    job_queue_limit: int = 1
+    # core工作目录下保存状态的目录(相对路径)，启动前备份，测试目录之间恢复来重置core
+    core_state_dirs: list[str] = []
+    # 工作目录中只有这些后缀的文件(以及linux上有可执行权限的文件)从解压好的版本硬链接，
+    # 其他文件(配置、数据库、日志等)都复制。硬链接的文件和版本缓存、其他core实例共用内容，
+    # core不能写这些文件
+    build_link_suffixes: list[str] = [".exe", ".dll", ".so", ".pdb", ".pyd"]
+    # 即使后缀匹配也要复制的目录(相对路径)，只有core会原地修改其中的二进制文件时才需要配置；
+    # core_state_dirs 总是复制
+    build_copy_dirs: list[str] = []
+    # core连续这么多次探测成功(失败)才认为已经启动(停止)
+    core_probe_stable_count: int = 2
+    # 探测间隔从很短开始逐渐增加，最大不超过这个值
+    core_probe_max_interval_sec: float = 1.0
+    # output_path 中任务输出的磁盘配额，超过时删除最久没有更新的任务输出
+    runs_budget_bytes: int = 50 * 1024**3
+    # builds_dir 中版本(解压目录和zip)的磁盘配额，超过时删除最久没有使用的版本
+    builds_budget_bytes: int = 20 * 1024**3
+    # 不会被删除的版本，md5或者名称
+    pinned_builds: list[str] = []
 
 
 if os.name == "nt":  # Windows
@@ -17,6 +44,7 @@ if os.name == "nt":  # Windows
         builds_dir="D:/test/builds",
         testcase_folder="C:/projects/AutoTest",
         output_path="D:/test/runs", 
+        run_index_path="D:/test/runs.db",
         pytest_path="C:/Users/yda/anaconda3/envs/py310/Scripts/pytest.exe",
         pytest_html_merger="C:/Users/yda/anaconda3/envs/py310/Scripts/pytest_html_merger.exe"
     )
@@ -26,6 +54,7 @@ else:  # Linux
         builds_dir="/tmp/coreci-testrunner/builds",
         testcase_folder="/tmp/coreci-testrunner/testcases",
         output_path="/tmp/coreci-testrunner/runs", 
+        run_index_path="/tmp/coreci-testrunner/runs.db",
         pytest_path="/usr/bin/pytest",
         pytest_html_merger="/usr/bin/pytest_html_merger"
     )
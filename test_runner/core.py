@@ -0,0 +1,149 @@
+"""
+core的生命周期管理
+
+1. 同一个版本的core在连续的测试目录和任务之间保持运行
+2. 测试目录之间恢复干净的状态目录来重置core，不冷启动
+3. 持有core的进程句柄，停止时直接结束进程，结束不了时按端口结束，不按进程名杀
+4. 只有版本变化、重置失败或健康检查失败时才重启
+"""
+
+import os
+import shutil
+import subprocess
+
+from test_runner.config import CI_CONFIG
+from test_runner.utils import (
+    core_probe,
+    is_core_running,
+    kill_core,
+    popen_core,
+    wait_until_core_started,
+    wait_until_core_stopped,
+)
+
+CORE_START_TIMEOUT_SEC = 30
+CORE_STOP_TIMEOUT_SEC = 30
+
+
+class CoreManager:
+    def __init__(self, port: int):
+        self.port = port
+        self.path: str | None = None
+        self.build_key: str | None = None  # md5 of the build, or its path
+        self.process: subprocess.Popen | None = None
+        # 执行过测试后状态目录不再干净，下一个测试目录之前要重置
+        self.dirty = False
+        self.error: str | None = None
+        self.probe = core_probe(port)
+        self.probe.stable_count = CI_CONFIG.core_probe_stable_count
+        self.probe.max_interval_sec = CI_CONFIG.core_probe_max_interval_sec
+
+    def _pristine_dir(self) -> str:
+        return os.path.join(CI_CONFIG.builds_dir, "pristine", str(self.port))
+
+    def healthy(self) -> bool:
+        if self.process is not None and self.process.poll() is not None:
+            return False
+        return is_core_running(self.port)
+
+    def ensure(self, path: str, build_key: str) -> bool:
+        """
+        保证 path 下版本为 build_key 的core在运行，已经在运行就直接复用
+
+        只有新生成的工作目录才保存干净的状态，保留下来的工作目录可能已经被上一个测试目录改过，
+        重启前从保存的干净状态恢复
+        """
+        if self.build_key == build_key and self.path == path:
+            if self.healthy():
+                print(f"reuse warm core on port {self.port}")
+                return True
+            self.stop()
+            self._restore_state()
+            return self._start()
+        self.stop()
+        self.path = path
+        self.build_key = build_key
+        self._snapshot_state()
+        return self._start()
+
+    def release(self):
+        """停止core并放弃当前的工作目录，之后的 ensure 会在新的工作目录上重新保存干净的状态"""
+        self.stop()
+        self.path = None
+        self.build_key = None
+
+    def prepare_for_case(self) -> bool:
+        """执行一个测试目录之前调用：状态脏了就重置，core不健康就重启"""
+        if not self.healthy():
+            print(f"core on port {self.port} is not healthy, restarting")
+            self.stop()
+            self._restore_state()
+            return self._start()
+        if self.dirty and not self.reset():
+            print(f"failed to reset core on port {self.port}, restarting")
+            self.stop()
+            self._restore_state()
+            return self._start()
+        return True
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def reset(self) -> bool:
+        """恢复干净的状态目录，没有配置状态目录时什么也不做"""
+        try:
+            self._restore_state()
+        except OSError as e:
+            print(f"failed to restore core state on port {self.port}: {e}")
+            return False
+        return self.healthy()
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=CORE_STOP_TIMEOUT_SEC / 2)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+            self.process = None
+        # 进程句柄无法结束core时(windows上通过cmd启动，或者core不是本进程启动的)，按端口结束，
+        # 不按进程名结束，否则会结束其他实例的core
+        if is_core_running(self.port):
+            kill_core(self.port)
+        if not wait_until_core_stopped(
+            timeout_sec=CORE_STOP_TIMEOUT_SEC, core_port=self.port
+        ):
+            print(f"core on port {self.port} did not stop")
+
+    def _start(self) -> bool:
+        self.process = popen_core(self.path, self.port)
+        if not wait_until_core_started(
+            timeout_sec=CORE_START_TIMEOUT_SEC, core_port=self.port
+        ):
+            self.error = (
+                f"Core did not start successfully within {CORE_START_TIMEOUT_SEC} seconds"
+            )
+            return False
+        self.error = None
+        self.dirty = False
+        return True
+
+    def _snapshot_state(self):
+        pristine = self._pristine_dir()
+        shutil.rmtree(pristine, ignore_errors=True)
+        for state_dir in CI_CONFIG.core_state_dirs:
+            src = os.path.join(self.path, state_dir)
+            if os.path.isdir(src):
+                shutil.copytree(src, os.path.join(pristine, state_dir), symlinks=True)
+
+    def _restore_state(self):
+        pristine = self._pristine_dir()
+        for state_dir in CI_CONFIG.core_state_dirs:
+            src = os.path.join(pristine, state_dir)
+            if not os.path.isdir(src):
+                continue
+            dst = os.path.join(self.path, state_dir)
+            shutil.rmtree(dst, ignore_errors=True)
+            shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+        self.dirty = False
@@ -0,0 +1,107 @@
+"""
+向dispatcher推送任务事件
+
+事件先放进内存队列，后台线程按目标地址攒成一批再发送，
+连接失败或者5xx的事件保留下来按退避重试，其他4xx的事件直接丢掉
+"""
+
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import requests
+
+from test_runner.test_job import RunnerEvent
+
+PUSH_TIMEOUT_SEC = 5
+# 这些4xx是暂时的，和连接失败、5xx一样重试，其他4xx直接丢掉
+RETRY_STATUS_CODES = (408, 429)
+
+
+class EventPusher:
+    def __init__(
+        self,
+        batch_size: int = 100,
+        linger_sec: float = 0.05,
+        max_backoff_sec: float = 30,
+        max_buffered: int = 10000,
+    ):
+        self.batch_size = batch_size
+        self.linger_sec = linger_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.session = requests.Session()
+        # (events_url, event)，缓存满了丢掉最旧的事件
+        self._events: deque[tuple[str, RunnerEvent]] = deque(maxlen=max_buffered)
+        self._cond = threading.Condition()
+        threading.Thread(target=self._loop, name="event-pusher", daemon=True).start()
+
+    def push(self, events_url: str | None, event: RunnerEvent):
+        if not events_url:
+            return
+        if not event.time:
+            event.time = datetime.now().isoformat()
+        with self._cond:
+            self._events.append((events_url, event))
+            self._cond.notify_all()
+
+    def _take_batch(self) -> tuple[str, list[RunnerEvent]]:
+        """取出最早的事件所属地址的一批事件，保持同一地址的事件顺序"""
+        url = self._events[0][0]
+        batch = []
+        rest = deque(maxlen=self._events.maxlen)
+        while self._events:
+            item = self._events.popleft()
+            if item[0] == url and len(batch) < self.batch_size:
+                batch.append(item[1])
+            else:
+                rest.append(item)
+        self._events = rest
+        return url, batch
+
+    def _loop(self):
+        failures = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._events) > 0)
+            # 稍等一会，让同一时刻产生的事件一起发送
+            time.sleep(self.linger_sec)
+            with self._cond:
+                url, batch = self._take_batch()
+            try:
+                res = self.session.post(
+                    url,
+                    data="[" + ",".join(e.model_dump_json() for e in batch) + "]",
+                    headers={"Content-Type": "application/json"},
+                    timeout=PUSH_TIMEOUT_SEC,
+                )
+            except requests.RequestException as e:
+                error = repr(e)
+            else:
+                if res.ok:
+                    failures = 0
+                    continue
+                if res.status_code not in RETRY_STATUS_CODES and res.status_code < 500:
+                    # 请求本身有问题(事件格式不对、地址已经失效)，重试也不会成功，
+                    # 丢掉这一批，不阻塞后面的事件
+                    print(
+                        f"dropped {len(batch)} events to {url}: "
+                        f"{res.status_code} {res.text[:200]}"
+                    )
+                    continue
+                error = f"{res.status_code} {res.reason}"
+            failures += 1
+            print(f"failed to push {len(batch)} events to {url}: {error}")
+            with self._cond:
+                self._requeue(url, batch)
+            delay = min(self.max_backoff_sec, 0.5 * 2 ** (failures - 1))
+            time.sleep(delay * random.uniform(0.5, 1.5))
+
+    def _requeue(self, url: str, batch: list[RunnerEvent]):
+        """失败的一批放回队首，超过缓存上限时和平时一样丢掉最旧的事件"""
+        self._events = deque(
+            itertools.chain(((url, event) for event in batch), self._events),
+            maxlen=self._events.maxlen,
+        )
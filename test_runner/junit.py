@@ -0,0 +1,40 @@
+"""
+解析 pytest --junitxml 生成的结果文件，得到每个测试的结果和耗时
+"""
+
+import xml.etree.ElementTree as ET
+
+from test_runner.test_job import TestCaseResult
+
+# 子元素 -> 结果，没有子元素表示通过
+OUTCOME_TAGS = {"failure": "failed", "error": "error", "skipped": "skipped"}
+MESSAGE_MAX_LEN = 1000
+
+
+def parse_junit_xml(path: str) -> list[TestCaseResult]:
+    """文件不存在或者不完整(pytest被中断)时返回空列表"""
+    try:
+        root = ET.parse(path).getroot()
+    except (OSError, ET.ParseError) as e:
+        print(f"failed to parse junit xml {path}: {e!r}")
+        return []
+    results = []
+    for testcase in root.iter("testcase"):
+        outcome = "passed"
+        message = None
+        for child in testcase:
+            if child.tag in OUTCOME_TAGS:
+                outcome = OUTCOME_TAGS[child.tag]
+                message = (child.get("message") or "")[:MESSAGE_MAX_LEN] or None
+                break
+        classname = testcase.get("classname", "")
+        name = testcase.get("name", "")
+        results.append(
+            TestCaseResult(
+                nodeid=f"{classname}::{name}" if classname else name,
+                outcome=outcome,
+                duration_sec=float(testcase.get("time") or 0),
+                message=message,
+            )
+        )
+    return results
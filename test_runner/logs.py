@@ -0,0 +1,86 @@
+"""
+按偏移量读取测试目录的 pytest.log
+
+客户端记住上次返回的偏移量，每次只取新增的内容，
+可以选择长轮询，等到有新内容或者测试目录结束再返回
+"""
+
+import asyncio
+import gzip
+import os
+import time
+from collections.abc import Callable
+
+from pydantic import BaseModel
+
+# 单次返回的最大字节数，客户端按返回的偏移量继续读
+TAIL_MAX_BYTES = 1024 * 1024
+# 长轮询时检查文件长度的间隔
+TAIL_POLL_INTERVAL_SEC = 0.25
+TAIL_MAX_WAIT_SEC = 30.0
+
+
+class LogChunk(BaseModel):
+    data: bytes
+    offset: int  # 下一次请求使用的偏移量
+    size: int  # 读取时文件的长度
+    complete: bool  # 测试目录已经结束，不会再有新内容
+
+
+def read_chunk(path: str, offset: int, max_bytes: int = TAIL_MAX_BYTES) -> tuple[bytes, int, int]:
+    """返回 (数据, 下一次的偏移量, 文件长度)，偏移量超过文件长度说明日志被重写，从头读"""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        # 任务结束后日志被压缩
+        return read_gzip_chunk(path + ".gz", offset, max_bytes)
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if offset > size:
+            offset = 0
+        f.seek(offset)
+        data = f.read(min(max_bytes, size - offset))
+    return data, offset + len(data), size
+
+
+def read_gzip_chunk(path: str, offset: int, max_bytes: int) -> tuple[bytes, int, int]:
+    """偏移量按解压后的内容计算"""
+    with gzip.open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if offset > size:
+            offset = 0
+        f.seek(offset)
+        data = f.read(min(max_bytes, size - offset))
+    return data, offset + len(data), size
+
+
+async def tail_log(
+    path: str,
+    offset: int,
+    wait_sec: float,
+    is_running: Callable[[], bool],
+) -> LogChunk | None:
+    """
+    读取 offset 之后的内容
+
+    没有新内容且 wait_sec > 0 时等待，直到有新内容、测试目录结束或者超时
+    日志不存在且测试目录不会再运行时返回 None
+    """
+    deadline = time.monotonic() + min(max(wait_sec, 0.0), TAIL_MAX_WAIT_SEC)
+    while True:
+        # 先判断是否结束再读，保证 complete 时返回的是完整的日志
+        running = is_running()
+        if os.path.exists(path) or os.path.exists(path + ".gz"):
+            data, next_offset, size = await asyncio.to_thread(read_chunk, path, offset)
+            if data or not running or time.monotonic() >= deadline:
+                return LogChunk(
+                    data=data,
+                    offset=next_offset,
+                    size=size,
+                    complete=not running and next_offset >= size,
+                )
+        elif not running:
+            return None
+        elif time.monotonic() >= deadline:
+            return LogChunk(data=b"", offset=offset, size=0, complete=False)
+        await asyncio.sleep(TAIL_POLL_INTERVAL_SEC)
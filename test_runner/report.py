@@ -0,0 +1,76 @@
+"""
+测试报告合并
+
+pytest_html_merger 每次都要读取整个输出目录，不能每个测试目录结束都在执行线程里调用。
+ReportMerger 在后台线程合并：合并期间收到的多次请求只会再合并一次，
+任务结束或被停止时 finalize() 同步地生成最终的 merged.html。
+"""
+
+import os
+import subprocess
+import threading
+
+
+def merge_reports(pytest_html_merger: str, run_output_path: str) -> int:
+    return subprocess.call(
+        [
+            pytest_html_merger,
+            "-i",
+            run_output_path,
+            "-o",
+            os.path.join(run_output_path, "merged.html"),
+        ]
+    )
+
+
+class ReportMerger:
+    def __init__(self, pytest_html_merger: str):
+        self._pytest_html_merger = pytest_html_merger
+        self._cond = threading.Condition()
+        self._pending: list[str] = []
+        self._merging: str | None = None
+        threading.Thread(
+            target=self._loop, name="report-merger", daemon=True
+        ).start()
+
+    def request(self, run_output_path: str):
+        """请求在后台合并，不等待合并完成"""
+        with self._cond:
+            if run_output_path not in self._pending:
+                self._pending.append(run_output_path)
+                self._cond.notify_all()
+
+    def finalize(self, run_output_path: str):
+        """等待进行中的后台合并结束，再同步合并一次，保证报告包含所有结果"""
+        with self._cond:
+            if run_output_path in self._pending:
+                self._pending.remove(run_output_path)
+            self._cond.wait_for(lambda: self._merging != run_output_path)
+            self._merging = run_output_path
+        try:
+            merge_reports(self._pytest_html_merger, run_output_path)
+        except OSError as e:
+            # 合并失败不影响任务结果，各测试目录的报告仍然在
+            print(f"failed to merge reports in {run_output_path}: {e}")
+        finally:
+            with self._cond:
+                self._merging = None
+                self._cond.notify_all()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._pending and self._merging is None
+                )
+                run_output_path = self._pending.pop(0)
+                self._merging = run_output_path
+            try:
+                ret = merge_reports(self._pytest_html_merger, run_output_path)
+                print(f"merged reports in {run_output_path}: {ret}")
+            except OSError as e:
+                print(f"failed to merge reports in {run_output_path}: {e}")
+            finally:
+                with self._cond:
+                    self._merging = None
+                    self._cond.notify_all()
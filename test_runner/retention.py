@@ -0,0 +1,131 @@
+"""
+输出目录和版本目录的磁盘配额
+
+任务结束后在后台压缩日志和报告(.gz)，记录输出目录大小，
+超过配额时按最近更新/使用时间淘汰最旧的任务输出和版本，
+正在执行或排队的任务、它们使用的版本以及配置中固定的版本不会被淘汰
+"""
+
+import gzip
+import os
+import shutil
+import threading
+from collections.abc import Callable
+
+from test_runner.builds import BuildStore
+from test_runner.run_index import RunIndex
+from test_runner.utils import dir_size
+
+# 任务结束后压缩的文件
+COMPRESSED_SUFFIXES = (".log", ".html", ".xml")
+# 淘汰任务输出时每次从索引读取的数量
+EVICT_BATCH = 20
+
+
+def gzip_file(path: str):
+    """写完 .gz 再删除原文件，任何时刻至少有一个可以访问"""
+    tmp_path = f"{path}.gz.tmp"
+    with open(path, "rb") as src, gzip.open(tmp_path, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp_path, f"{path}.gz")
+    os.remove(path)
+
+
+def compress_run(run_output_path: str):
+    for root, _, files in os.walk(run_output_path):
+        for name in files:
+            if name.endswith(COMPRESSED_SUFFIXES):
+                try:
+                    gzip_file(os.path.join(root, name))
+                except OSError as e:
+                    print(f"failed to compress {name} in {root}: {e}")
+
+
+class Retention:
+    def __init__(
+        self,
+        output_path: str,
+        run_index: RunIndex,
+        builds: BuildStore,
+        runs_budget_bytes: int,
+        builds_budget_bytes: int,
+        pinned_builds: list[str],
+        in_use: Callable[[], tuple[set[str], set[str]]],
+    ):
+        """in_use 返回 (不能删除的任务id, 不能删除的版本md5)"""
+        self._output_path = output_path
+        self._run_index = run_index
+        self._builds = builds
+        self._runs_budget_bytes = runs_budget_bytes
+        self._builds_budget_bytes = builds_budget_bytes
+        self._pinned_builds = set(pinned_builds)
+        self._in_use = in_use
+        self._cond = threading.Condition()
+        self._finished: list[str] = []
+        self._sweep_requested = True
+        threading.Thread(target=self._loop, name="retention", daemon=True).start()
+
+    def job_finished(self, job_id: str):
+        """任务结束后调用，在后台压缩输出再检查配额"""
+        with self._cond:
+            self._finished.append(job_id)
+            self._sweep_requested = True
+            self._cond.notify_all()
+
+    def request_sweep(self):
+        with self._cond:
+            self._sweep_requested = True
+            self._cond.notify_all()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._finished or self._sweep_requested)
+                finished, self._finished = self._finished, []
+                self._sweep_requested = False
+            try:
+                for job_id in finished:
+                    run_output_path = os.path.join(self._output_path, job_id)
+                    compress_run(run_output_path)
+                    self._run_index.set_size(job_id, dir_size(run_output_path))
+                self.sweep()
+            except Exception as e:
+                print(f"retention failed: {e!r}")
+
+    def sweep(self):
+        active_jobs, active_builds = self._in_use()
+        self._evict_runs(active_jobs)
+        self._evict_builds(active_builds)
+
+    def _evict_runs(self, active_jobs: set[str]):
+        total = self._run_index.total_size()
+        skipped: set[str] = set()
+        while total > self._runs_budget_bytes:
+            candidates = [
+                (run_id, size)
+                for run_id, size in self._run_index.oldest(EVICT_BATCH + len(skipped))
+                if run_id not in skipped
+            ]
+            if not candidates:
+                return
+            for run_id, size in candidates:
+                if total <= self._runs_budget_bytes:
+                    return
+                if run_id in active_jobs:
+                    skipped.add(run_id)
+                    continue
+                shutil.rmtree(os.path.join(self._output_path, run_id), ignore_errors=True)
+                self._run_index.remove(run_id)
+                total -= size
+                print(f"evicted run {run_id} ({size} bytes)")
+
+    def _evict_builds(self, active_builds: set[str]):
+        builds = self._builds.list_builds()
+        total = sum(build.size_bytes for build in builds)
+        for build in builds:
+            if total <= self._builds_budget_bytes:
+                return
+            if build.md5 in active_builds or {build.md5, build.name} & self._pinned_builds:
+                continue
+            self._builds.remove(build)
+            total -= build.size_bytes
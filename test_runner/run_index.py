@@ -0,0 +1,225 @@
+"""
+runner执行过的任务的索引
+
+任务开始、每个测试目录结束、任务结束时更新，/runs 页面按更新时间倒序分页读取，
+不需要扫描整个输出目录
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from test_runner.test_job import RunnerTestJob
+from test_runner.utils import dir_size
+
+
+class RunRecord(BaseModel):
+    id: str
+    rdscore_version: str | None = None
+    testcase_mark: str | None = None
+    status: str
+    error: str | None = None
+    cases: list[str] = []  # finished test directories
+    start_time: str  # iso8601
+    update_time: str  # iso8601
+
+
+class RunPage(BaseModel):
+    runs: list[RunRecord]
+    next_cursor: str | None = None  # pass as cursor to get the next page
+    etag: str
+
+
+class RunIndex:
+    """sqlite(WAL模式)，按 (update_time, id) 做游标分页，版本和状态过滤都有索引"""
+
+    def __init__(self, db_path: str):
+        os.makedirs(Path(db_path).parent, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS runs (
+                id TEXT PRIMARY KEY,
+                rdscore_version TEXT,
+                testcase_mark TEXT,
+                status TEXT NOT NULL,
+                error TEXT,
+                cases TEXT NOT NULL,
+                start_time TEXT NOT NULL,
+                update_time TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        for name, columns in (
+            ("update_time", "update_time, id"),
+            ("version", "rdscore_version, update_time, id"),
+            ("status", "status, update_time, id"),
+        ):
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_runs_{name} ON runs ({columns})"
+            )
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM runs LIMIT 1").fetchone() is None
+
+    def _upsert(self, record: RunRecord):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO runs (id, rdscore_version, testcase_mark, status, error, "
+                "cases, start_time, update_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET rdscore_version = excluded.rdscore_version, "
+                "testcase_mark = excluded.testcase_mark, status = excluded.status, "
+                "error = excluded.error, cases = excluded.cases, "
+                "update_time = excluded.update_time",
+                (
+                    record.id,
+                    record.rdscore_version,
+                    record.testcase_mark,
+                    record.status,
+                    record.error,
+                    json.dumps(record.cases),
+                    record.start_time,
+                    record.update_time,
+                ),
+            )
+
+    def update(self, job: RunnerTestJob):
+        """任务开始、测试目录结束、任务结束时调用"""
+        now = datetime.now().isoformat()
+        self._upsert(
+            RunRecord(
+                id=job.id,
+                rdscore_version=job.rdscore_version,
+                testcase_mark=job.testcase_mark,
+                status=job.runner_status.value,
+                error=job.error,
+                cases=list(job.finished_cases),
+                start_time=now,
+                update_time=now,
+            )
+        )
+
+    def backfill(self, output_path: str):
+        """第一次启动时把输出目录中已有的任务导入索引，只在索引为空时调用"""
+        if not os.path.isdir(output_path):
+            return
+        for run in os.scandir(output_path):
+            if not run.is_dir():
+                continue
+            mtime = datetime.fromtimestamp(run.stat().st_mtime).isoformat()
+            cases = sorted(
+                entry.name
+                for entry in os.scandir(run.path)
+                if entry.is_dir() and entry.name.startswith("test_")
+            )
+            self._upsert(
+                RunRecord(
+                    id=run.name,
+                    status="unknown",
+                    cases=cases,
+                    start_time=mtime,
+                    update_time=mtime,
+                )
+            )
+            self.set_size(run.name, dir_size(run.path))
+
+    def set_size(self, run_id: str, size_bytes: int):
+        """任务结束并压缩后记录输出目录的大小，用于磁盘配额"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE runs SET size_bytes = ? WHERE id = ?", (size_bytes, run_id)
+            )
+
+    def total_size(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(size_bytes), 0) FROM runs"
+            ).fetchone()[0]
+
+    def oldest(self, limit: int) -> list[tuple[str, int]]:
+        """最久没有更新的任务 (id, size_bytes)"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, size_bytes FROM runs ORDER BY update_time, id LIMIT ?",
+                (limit,),
+            ).fetchall()
+
+    def remove(self, run_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM runs WHERE id = ?", (run_id,))
+
+    @staticmethod
+    def _record(row) -> RunRecord:
+        return RunRecord(
+            id=row[0],
+            rdscore_version=row[1],
+            testcase_mark=row[2],
+            status=row[3],
+            error=row[4],
+            cases=json.loads(row[5]),
+            start_time=row[6],
+            update_time=row[7],
+        )
+
+    def get(self, run_id: str) -> RunRecord | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, rdscore_version, testcase_mark, status, error, cases, "
+                "start_time, update_time FROM runs WHERE id = ?",
+                (run_id,),
+            ).fetchone()
+        return None if row is None else self._record(row)
+
+    def list(
+        self,
+        limit: int = 50,
+        cursor: str | None = None,
+        rdscore_version: str | None = None,
+        status: str | None = None,
+    ) -> RunPage:
+        """
+        按更新时间从新到旧，cursor 是上一页返回的 next_cursor
+
+        etag 由这一页的内容计算，代价和页大小成正比
+        """
+        conditions, params = [], []
+        if rdscore_version is not None:
+            conditions.append("rdscore_version = ?")
+            params.append(rdscore_version)
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        if cursor:
+            update_time, _, run_id = cursor.partition("|")
+            conditions.append("(update_time, id) < (?, ?)")
+            params.extend((update_time, run_id))
+        where = " AND ".join(conditions) or "1"
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, rdscore_version, testcase_mark, status, error, cases, "
+                f"start_time, update_time FROM runs WHERE {where} "
+                "ORDER BY update_time DESC, id DESC LIMIT ?",
+                (*params, limit + 1),
+            ).fetchall()
+        runs = [self._record(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = f"{runs[-1].update_time}|{runs[-1].id}"
+        digest = hashlib.md5()
+        for run in runs:
+            digest.update(f"{run.id}|{run.update_time}|{run.status};".encode())
+        digest.update(f"{cursor}|{next_cursor}".encode())
+        return RunPage(runs=runs, next_cursor=next_cursor, etag=f'"{digest.hexdigest()}"')
@@ -0,0 +1,51 @@
+"""
+/files 挂载的静态文件，支持任务结束后压缩过的文件
+
+请求 x.html 而磁盘上只有 x.html.gz 时，客户端接受gzip就直接发送压缩文件
+(Content-Encoding: gzip)，否则边解压边发送
+"""
+
+import gzip
+import mimetypes
+
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+GZIP_SUFFIX = ".gz"
+
+
+def iter_gunzip(path: str, chunk_size: int = 1024 * 1024):
+    with gzip.open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        try:
+            return await super().get_response(path, scope)
+        except HTTPException as e:
+            if e.status_code != 404 or path.endswith(GZIP_SUFFIX):
+                raise
+        full_path, stat_result = self.lookup_path(path + GZIP_SUFFIX)
+        if stat_result is None:
+            raise HTTPException(status_code=404)
+        media_type = mimetypes.guess_type(path)[0] or "text/plain"
+        if media_type.startswith("text/"):
+            media_type += "; charset=utf-8"
+        accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+        if "gzip" in accept_encoding:
+            return FileResponse(
+                full_path,
+                stat_result=stat_result,
+                media_type=media_type,
+                headers={"content-encoding": "gzip", "vary": "accept-encoding"},
+            )
+        return StreamingResponse(
+            iter_gunzip(full_path),
+            media_type=media_type,
+            headers={"vary": "accept-encoding"},
+        )
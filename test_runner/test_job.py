@@ -1,4 +1,4 @@
-from enum import Enum
+from enum import Enum, StrEnum
 from pydantic import BaseModel
 from datetime import datetime
 
@@ -20,6 +20,12 @@ class TestJob(BaseModel):
     report_url: str | None = None
     tested_cases: list[str] = []
     start_time: str
+    cases: list[str] | None = None  # test directories to run, None means all
+    rdscore_file_url: str = ""  # URL to download the rdscore zip
+    rdscore_md5: str = ""
+    rdscore_peer_urls: list[str] = []  # other runners holding the build, tried before rdscore_file_url
+    events_url: str = ""  # where the runner pushes job events, empty to disable
+    case_durations: dict[str, float] = {}  # historical seconds per test directory
 
 
 class RunnerTestJob(BaseModel):
@@ -33,8 +39,43 @@ class RunnerTestJob(BaseModel):
     error: str | None = None
     rdscore_file_path_abs : str | None = None # This is the absolute path to the rdscore file
     rdscore_file_url: str | None = None # This is the URL to download the rdscore file, not the local path
+    rdscore_md5: str | None = None  # md5 of the rdscore zip, used to verify the download
+    rdscore_peer_urls: list[str] = []
     report_url: str | None = None  # URL to access the report after the job is finished
     log_url: str | None = None  # URL to access the log file after the job is finished
+    cases: list[str] | None = None  # test directories to run, None means all
+    testcase_folder: str | None = None
+    report_path: str | None = None  # folder where the outputs of all runs are stored
+    events_url: str | None = None  # where the runner pushes job events
+    case_durations: dict[str, float] = {}
+
+
+class RunnerEventType(StrEnum):
+    job_started = "job_started"
+    case_started = "case_started"
+    case_finished = "case_finished"
+    job_finished = "job_finished"
+
+
+class TestCaseResult(BaseModel):
+    nodeid: str  # classname::name from the junit xml
+    outcome: str  # passed, failed, error, skipped
+    duration_sec: float
+    message: str | None = None  # failure/error/skip message
+
+
+class RunnerEvent(BaseModel):
+    type: RunnerEventType
+    job_id: str
+    time: str = ""  # iso8601
+    case: str | None = None
+    result: int | None = None  # pytest exit code of the case
+    duration_sec: float | None = None
+    status: TestJobStatus | None = None  # job status on job_finished
+    error: str | None = None
+    finished_cases: list[str] | None = None
+    report_url: str | None = None  # path on the runner, e.g. /files/{job_id}/merged.html
+    tests: list[TestCaseResult] | None = None  # per-test results on case_finished
 
 
 class TestJobCtx(BaseModel):
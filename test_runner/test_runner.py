@@ -1,16 +1,22 @@
+import asyncio
 from contextlib import asynccontextmanager
-import datetime
+import hashlib
 import os
 import threading
 
 from fastapi import FastAPI, Request
-from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response
 
 from test_runner.config import CI_CONFIG
+from test_runner.logs import tail_log
+from test_runner.static_files import PrecompressedStaticFiles
 from test_runner.test_job import TestJob
-from test_runner.test_runner_impl import TestRunner, create_sample_test_job
+from test_runner.test_runner_impl import (
+    TestRunner,
+    create_sample_test_job,
+    list_test_cases,
+)
 from pathlib import Path
 
 templates = {}
@@ -28,11 +34,11 @@ async def lifespan(app: FastAPI):
     )
     app.mount(
         "/files",
-        StaticFiles(directory=os.path.abspath(CI_CONFIG.output_path)),
+        PrecompressedStaticFiles(directory=os.path.abspath(CI_CONFIG.output_path)),
         name="TestOutput",
     )
     global runner
-    runner = TestRunner(10)
+    runner = TestRunner(CI_CONFIG.job_queue_limit)
     threading.Thread(group=None, target=runner.run, daemon=True).start()
 
     yield
@@ -66,34 +72,99 @@ async def accept_test_job(job: TestJob):
     return runner.accept_test_job(job)
 
 
+@app.get("/test/job/{job_id}")
+async def get_test_job(job_id: str):
+    job = runner.get_job(job_id)
+    if job is None:
+        return JSONResponse({"error": "job not found"}, status_code=404)
+    return job
+
+
+@app.get("/test/job/{job_id}/log/{case}")
+async def tail_case_log(job_id: str, case: str, offset: int = 0, wait: float = 0):
+    """
+    返回 pytest.log 从 offset 开始的新内容
+
+    X-Log-Offset 是下一次请求的偏移量，X-Log-Complete 为 true 时不会再有新内容，
+    wait 大于0时没有新内容会等待最多 wait 秒
+    """
+    if Path(job_id).name != job_id or Path(case).name != case or ".." in (job_id, case):
+        return JSONResponse({"error": "invalid job id or case"}, status_code=400)
+    path = os.path.join(CI_CONFIG.output_path, job_id, case, "pytest.log")
+    chunk = await tail_log(
+        path, max(offset, 0), wait, lambda: runner.is_case_pending(job_id, case)
+    )
+    if chunk is None:
+        return JSONResponse({"error": "log not found"}, status_code=404)
+    return Response(
+        chunk.data,
+        media_type="text/plain",
+        headers={
+            "x-log-offset": str(chunk.offset),
+            "x-log-size": str(chunk.size),
+            "x-log-complete": "true" if chunk.complete else "false",
+        },
+    )
+
+
+@app.get("/test/cases")
+async def get_test_cases():
+    return list_test_cases(CI_CONFIG.testcase_folder)
+
+
+RUNS_PAGE_SIZE = 50
+
+
 @app.get("/runs", response_class=HTMLResponse)
-async def list_runs(request: Request):
-    # [runid, report, updatetime]
-    run_info_list = []
-    for run in os.scandir(CI_CONFIG.output_path):
-        last_modified_epoch_seconds = run.stat().st_mtime
-        last_modified_time_str = datetime.datetime.fromtimestamp(
-            last_modified_epoch_seconds
-        )
-        run_info_list.append(
-            [
-                run.name,
-                request.base_url._url + "files/" + run.name + "/merged.html",
-                last_modified_time_str,
-            ]
-        )
-    run_info_list = sorted(run_info_list, key=lambda a: a[2])
-    base_path = request.url._url
+async def list_runs(
+    request: Request,
+    cursor: str | None = None,
+    version: str | None = None,
+    status: str | None = None,
+    limit: int = RUNS_PAGE_SIZE,
+):
+    """从索引按更新时间倒序分页，下一页的链接带上 cursor"""
+    page = runner.run_index.list(max(1, min(limit, 500)), cursor, version, status)
+    if page.etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"etag": page.etag})
+    next_url = None
+    if page.next_cursor is not None:
+        next_url = str(request.url.include_query_params(cursor=page.next_cursor))
     return templates.TemplateResponse(
         "list_runs.html",
-        {"request": request, "runs": run_info_list, "base_path": base_path},
+        {
+            "request": request,
+            "runs": page.runs,
+            "files_base": request.base_url._url + "files/",
+            "base_path": request.base_url._url + "runs",
+            "next_url": next_url,
+        },
+        headers={"etag": page.etag},
     )
 
 
+@app.get("/api/runs")
+async def list_runs_json(
+    request: Request,
+    cursor: str | None = None,
+    version: str | None = None,
+    status: str | None = None,
+    limit: int = RUNS_PAGE_SIZE,
+):
+    page = runner.run_index.list(max(1, min(limit, 500)), cursor, version, status)
+    if page.etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"etag": page.etag})
+    return JSONResponse(page.model_dump(), headers={"etag": page.etag})
+
+
 @app.get("/runs/{runid}", response_class=HTMLResponse)
 async def list_output_for_single_run(request: Request, runid: str):
-    base_folder = os.path.join(CI_CONFIG.output_path, runid)
-    folders = list(filter(lambda f: f.startswith("test_"), os.listdir(base_folder)))
+    run = runner.run_index.get(runid)
+    if run is None:
+        return HTMLResponse("run not found", status_code=404)
+    etag = f'"{run.update_time}"'
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"etag": etag})
     base_path = request.base_url._url + "files/" + runid
     return templates.TemplateResponse(
         "files_of_run.html",
@@ -101,11 +172,49 @@ async def list_output_for_single_run(request: Request, runid: str):
             "request": request,
             "runid": runid,
             "base_path": base_path,
-            "folders": folders,
+            "folders": run.cases,
         },
+        headers={"etag": etag},
     )
 
 
+@app.post("/test/storage/versions/upload/{md5}")
+async def upload_build(md5: str, request: Request, name: str = ""):
+    """
+    dispatcher推送版本，请求体就是zip，边接收边写文件并计算md5
+
+    已经有这个版本时不读取请求体，直接返回
+    """
+    if runner.builds.has(md5):
+        return {"stored": False, "md5": md5}
+    path = runner.builds.upload_path()
+    digest = hashlib.md5()
+    try:
+        with open(path, "wb") as f:
+            async for chunk in request.stream():
+                digest.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        if digest.hexdigest() != md5:
+            return JSONResponse(
+                {"error": f"md5 is {digest.hexdigest()}, expected {md5}"},
+                status_code=400,
+            )
+        await asyncio.to_thread(runner.builds.add_zip, path, md5, name or md5)
+    finally:
+        if path.exists():
+            path.unlink()
+    return {"stored": True, "md5": md5}
+
+
+@app.get("/test/storage/builds/{md5}.zip")
+async def download_build(md5: str):
+    """其他runner从这里下载已经缓存的版本，减轻dispatcher的上行带宽"""
+    path = runner.builds.zip_path(md5)
+    if path is None:
+        return JSONResponse({"error": "build not found"}, status_code=404)
+    return FileResponse(path, media_type="application/zip", headers={"etag": f'"{md5}"'})
+
+
 @app.post("/test/current-job/stop")
 async def stop_current_job():
     runner.stop()
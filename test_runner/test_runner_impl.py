@@ -9,21 +9,35 @@ T2
 
 import os
 import pathlib
+import queue
+import shutil
 import subprocess
+import threading
 import time
 import uuid
 
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
+from test_runner.builds import BuildStore, link_tree
 from test_runner.config import CI_CONFIG
-from test_runner.test_job import AcceptTestJobResponse, CreateTestJobResponse, RunnerTestJob, TestJobStatus, TestJob
-from test_runner.utils import (
-    is_core_running,
-    kill_core,
-    start_core,
-    wait_until_core_started,
-    wait_until_core_stopped,
+from test_runner.report import ReportMerger
+from test_runner.retention import Retention
+from test_runner.run_index import RunIndex
+from test_runner.events import EventPusher
+from test_runner.junit import parse_junit_xml
+from test_runner.test_job import (
+    AcceptTestJobResponse,
+    CreateTestJobResponse,
+    RunnerEvent,
+    RunnerEventType,
+    RunnerTestJob,
+    TestJobStatus,
+    TestJob,
 )
+from test_runner.core import CoreManager
+from test_runner.utils import CORE_PORT_ENV, testcase_revision
 
 def create_sample_test_job() -> RunnerTestJob:
     j = RunnerTestJob()
@@ -35,18 +49,83 @@ def create_sample_test_job() -> RunnerTestJob:
 def identify_os():
     return os.name
 
+class CoreSlot:
+    """一个core实例，有自己的端口和工作目录"""
+
+    def __init__(self, index: int, port: int, path: str):
+        self.index = index
+        self.port = port
+        self.path = path
+
+
+def list_test_cases(testcase_folder: str) -> list[str]:
+    """测试用例目录 test_rdscore 下所有 test 开头的文件夹"""
+    test_rdscore_path = pathlib.Path(testcase_folder).joinpath("test_rdscore")
+    if not test_rdscore_path.is_dir():
+        return []
+    return sorted(
+        entry.name
+        for entry in os.scandir(test_rdscore_path)
+        if entry.name.startswith("test") and entry.is_dir()
+    )
+
+
+def order_longest_first(entries: list[os.DirEntry], durations: dict[str, float]) -> list[os.DirEntry]:
+    """
+    按dispatcher估计的耗时从长到短排序，耗时相同时按名称
+
+    dispatcher还不知道的新目录和dispatcher一样按已知耗时的中位数估计，
+    一个都不知道时保持按名称的顺序
+    """
+    known = sorted(durations[entry.name] for entry in entries if entry.name in durations)
+    default = known[len(known) // 2] if known else 0.0
+    return sorted(
+        entries,
+        key=lambda entry: (-durations.get(entry.name, default), entry.name),
+    )
+
+
 class TestRunner:
     _stop_current_job = False
     _current_job: RunnerTestJob | None = None
     _running = False
     _os: str
+    # 保留最近完成的任务，dispatcher按id查询结果
+    FINISHED_JOBS_LIMIT = 100
 
     def __init__(self, job_q_limit):
         self._os = "windows" if identify_os() == "nt" else "linux"
+        self._finished_jobs: OrderedDict[str, RunnerTestJob] = OrderedDict()
+        self._report_merger = ReportMerger(CI_CONFIG.pytest_html_merger)
+        # 等待执行的任务，最多 job_q_limit 个
+        self._job_q_limit = job_q_limit
+        self._queue: deque[RunnerTestJob] = deque()
+        self._queue_cond = threading.Condition()
+        # 排队任务的版本在后台按顺序下载解压
+        self._builds = BuildStore(CI_CONFIG.builds_dir)
+        self._prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._prefetched: dict[str, Future] = {}
+        # 端口 -> core，任务之间保持不变，相同版本的core可以复用
+        self._cores: dict[int, CoreManager] = {}
+        self._events = EventPusher()
+        self.run_index = RunIndex(CI_CONFIG.run_index_path)
+        if self.run_index.is_empty():
+            self.run_index.backfill(CI_CONFIG.output_path)
+        self._retention = Retention(
+            CI_CONFIG.output_path,
+            self.run_index,
+            self._builds,
+            CI_CONFIG.runs_budget_bytes,
+            CI_CONFIG.builds_budget_bytes,
+            CI_CONFIG.pinned_builds,
+            self._in_use,
+        )
         print("os: "+self._os)
         
     def stop(self):
-        self._stop_current_job = True
+        with self._queue_cond:
+            self._stop_current_job = True
+            self._queue_cond.notify_all()
 
     def current_job(self):
         return self._current_job
@@ -54,54 +133,236 @@ class TestRunner:
     def run(self):
         print("Started TestRunner")
         while True:
-            time.sleep(1)
-
-            if self._stop_current_job:
-                print("Stopping current job")
-                if self._current_job:
-                    self._current_job.status = TestJobStatus.failed
-                    self._current_job.error = "Stopped by user"
-                self._stop_current_job = False
-                continue
-            if self._current_job is None:
-                continue
-            self._running = True
+            with self._queue_cond:
+                self._queue_cond.wait_for(
+                    lambda: self._queue or self._stop_current_job, timeout=1
+                )
+                if self._stop_current_job:
+                    # 没有正在执行的任务，忽略停止请求
+                    print("No job to stop")
+                    self._stop_current_job = False
+                    continue
+                if not self._queue:
+                    continue
+                self._current_job = self._queue.popleft()
+                self._running = True
+            job = self._current_job
+            # 执行线程只有一个，任何异常都只让这个任务失败，不能让线程退出
+            try:
+                self.run_index.update(job)
+                self._events.push(
+                    job.events_url,
+                    RunnerEvent(type=RunnerEventType.job_started, job_id=job.id),
+                )
+                self._prepare_build(job)
+                if job.runner_status == TestJobStatus.pending:
+                    self.run_test_job(job)
+            except Exception as e:
+                print(f"job {job.id} failed unexpectedly: {e!r}")
+                job.runner_status = TestJobStatus.failed
+                job.error = f"Unexpected error: {e!r}"
+            finally:
+                self._finish_current_job()
+
+    def _fetch_build(self, job: RunnerTestJob) -> str:
+        if job.rdscore_file_path_abs:
+            return job.rdscore_file_path_abs
+        if not job.rdscore_file_url or not job.rdscore_md5:
+            raise ValueError("Rdscore file url and md5 cannot be empty")
+        return self._builds.ensure(
+            [*job.rdscore_peer_urls, job.rdscore_file_url],
+            job.rdscore_md5,
+            job.rdscore_version,
+        )
+
+    def _prepare_build(self, job: RunnerTestJob):
+        """取出后台下载的结果，还没下载完就等待"""
+        future = self._prefetched.pop(job.id, None)
+        try:
+            if future is None:
+                job.rdscore_file_path_abs = self._fetch_build(job)
+            else:
+                job.rdscore_file_path_abs = future.result()
+        except Exception as e:
+            print(f"failed to prepare build for {job.id}: {e}")
+            job.runner_status = TestJobStatus.failed
+            job.error = f"Failed to prepare rdscore build: {e}"
+
+    def _finish_current_job(self):
+        job = self._current_job
+        self._finished_jobs[job.id] = job
+        while len(self._finished_jobs) > self.FINISHED_JOBS_LIMIT:
+            self._finished_jobs.popitem(last=False)
+        self._current_job = None
+        self._running = False
+        try:
+            self.run_index.update(job)
+        except Exception as e:
+            print(f"failed to update run index for {job.id}: {e!r}")
+        self._retention.job_finished(job.id)
+        # 先更新状态再推送，dispatcher收到后查询 /info 时这个runner已经空闲
+        self._events.push(
+            job.events_url,
+            RunnerEvent(
+                type=RunnerEventType.job_finished,
+                job_id=job.id,
+                status=job.runner_status,
+                error=job.error,
+                finished_cases=list(job.finished_cases),
+                report_url=f"/files/{job.id}/merged.html",
+            ),
+        )
+
+    def get_job(self, job_id: str) -> RunnerTestJob | None:
+        if self._current_job is not None and self._current_job.id == job_id:
+            return self._current_job
+        for job in list(self._queue):
+            if job.id == job_id:
+                return job
+        return self._finished_jobs.get(job_id)
+
+    @property
+    def builds(self) -> BuildStore:
+        return self._builds
+
+    def _in_use(self) -> tuple[set[str], set[str]]:
+        """正在执行和排队的任务，以及它们的版本，磁盘配额不会删除这些"""
+        with self._queue_cond:
+            jobs = list(self._queue)
+            if self._current_job is not None:
+                jobs.append(self._current_job)
+        build_md5s = {job.rdscore_md5 for job in jobs if job.rdscore_md5}
+        # 工作目录复制自的版本也在使用
+        build_md5s.update(core.build_key for core in self._cores.values() if core.build_key)
+        return {job.id for job in jobs}, build_md5s
+
+    def is_case_pending(self, job_id: str, case: str) -> bool:
+        """测试目录正在运行或者还会运行"""
+        job = self.get_job(job_id)
+        if job is None or job.id in self._finished_jobs:
+            return False
+        return case not in job.finished_cases
 
     def accept_test_job(self, job: RunnerTestJob)->AcceptTestJobResponse:
-        # 如果正在执行，就不能接受新任务
-        if self._running:
-            return AcceptTestJobResponse(accepted=False, error="TestRunner is currently running a job")
+        # 排队的任务满了，就不能接受新任务
+        if len(self._queue) >= self._job_q_limit:
+            return AcceptTestJobResponse(accepted=False, error="TestRunner job queue is full")
         return AcceptTestJobResponse(accepted=True)
 
     def run_test_job(self, job: RunnerTestJob):
         if job.testcase_folder is None:
-            job.status = TestJobStatus.failed
+            job.runner_status = TestJobStatus.failed
             job.error = "Testcase folder cannot be None"
             return
         if job.rdscore_version is None:
-            job.status = TestJobStatus.failed
+            job.runner_status = TestJobStatus.failed
             job.error = "Rdscore version cannot be None"
             return
+        if job.rdscore_file_path_abs is None:
+            job.runner_status = TestJobStatus.failed
+            job.error = "Rdscore file path cannot be None"
+            return
 
-        if not self._stop_core_and_start(job):
-            job.status = TestJobStatus.failed
-            job.error = "Core did not start successfully"
+        try:
+            slots = self._prepare_slots(job)
+        except OSError as e:
+            job.runner_status = TestJobStatus.failed
+            job.error = f"Failed to prepare core working copies: {e}"
             return
+        for slot in slots:
+            if not self._ensure_core(job, slot):
+                job.runner_status = TestJobStatus.failed
+                job.error = job.error or "Core did not start successfully"
+                return
 
-        job.status = TestJobStatus.running
+        job.runner_status = TestJobStatus.running
 
         test_rdscore_path = pathlib.Path(job.testcase_folder).joinpath("test_rdscore")
         run_output_path = os.path.join(job.report_path, job.id)
 
+        entries = []
         for entry in os.scandir(test_rdscore_path):
             if not entry.name.startswith("test") or not entry.is_dir():
                 continue
-            if not self._process_entry(entry, job, run_output_path):
-                job.status = TestJobStatus.failed
-                job.error = "Failed to process entry"
-                break
+            # 分片任务只执行分配给自己的目录
+            if job.cases is not None and entry.name not in job.cases:
+                continue
+            entries.append(entry)
+        # 耗时最长的目录先执行，多个core时相当于按LPT分配，缩短整个任务的耗时
+        entries = order_longest_first(entries, job.case_durations)
 
-        job.status = TestJobStatus.finished
+        try:
+            if len(slots) == 1:
+                for entry in entries:
+                    if not self._process_entry(entry, job, run_output_path, slots[0]):
+                        job.runner_status = TestJobStatus.failed
+                        job.error = job.error or "Failed to process entry"
+                        return
+            elif not self._run_entries_in_slots(entries, job, run_output_path, slots):
+                job.runner_status = TestJobStatus.failed
+                job.error = job.error or "Failed to process entry"
+                return
+        finally:
+            # 不论正常结束、失败还是被停止，都生成最终的合并报告
+            if os.path.isdir(run_output_path):
+                self._report_merger.finalize(run_output_path)
+
+        job.runner_status = TestJobStatus.finished
+
+    def _core_for(self, slot: CoreSlot) -> CoreManager:
+        if slot.port not in self._cores:
+            self._cores[slot.port] = CoreManager(slot.port)
+        return self._cores[slot.port]
+
+    def _prepare_slots(self, job: RunnerTestJob) -> list[CoreSlot]:
+        """
+        每个core实例一份工作目录，从解压好的版本生成，不重新解压，二进制文件硬链接不复制内容
+
+        实例上运行的已经是这个版本时，保留工作目录和正在运行的core
+        """
+        build_key = job.rdscore_md5 or job.rdscore_file_path_abs
+        copy_dirs = CI_CONFIG.core_state_dirs + CI_CONFIG.build_copy_dirs
+        slots = []
+        for i in range(CI_CONFIG.core_slots):
+            slot = CoreSlot(
+                i,
+                CI_CONFIG.core_base_port + i,
+                os.path.join(CI_CONFIG.builds_dir, "slots", f"slot{i}"),
+            )
+            core = self._core_for(slot)
+            if core.build_key != build_key or not os.path.exists(slot.path):
+                core.release()
+                shutil.rmtree(slot.path, ignore_errors=True)
+                link_tree(
+                    job.rdscore_file_path_abs,
+                    slot.path,
+                    copy_dirs,
+                    CI_CONFIG.build_link_suffixes,
+                )
+            slots.append(slot)
+        return slots
+
+    def _run_entries_in_slots(
+        self, entries, job: RunnerTestJob, run_output_path: str, slots: list[CoreSlot]
+    ) -> bool:
+        """每个core实例一个线程，从队列中取测试目录执行"""
+        pending = queue.SimpleQueue()
+        for entry in entries:
+            pending.put(entry)
+        failed = threading.Event()
+
+        def worker(slot: CoreSlot):
+            while not failed.is_set():
+                try:
+                    entry = pending.get_nowait()
+                except queue.Empty:
+                    return
+                if not self._process_entry(entry, job, run_output_path, slot):
+                    failed.set()
+
+        with ThreadPoolExecutor(max_workers=len(slots)) as executor:
+            list(executor.map(worker, slots))
+        return not failed.is_set()
 
     def run_test_job2(self, job:RunnerTestJob):
         """
@@ -117,83 +378,114 @@ class TestRunner:
 
 
     def get_info(self):
-        return {"os": CI_CONFIG.os, "current_job": self._current_job}
-
-    def _stop_core_and_start(self, job: RunnerTestJob) -> bool:
-        if is_core_running():
-            kill_core()
-        if not wait_until_core_stopped(timeout_sec=30):
-            job.status = TestJobStatus.failed
-            job.error = "Core did not stop successfully within 30 seconds"
-            return False
+        return {
+            "os": CI_CONFIG.os,
+            "current_job": self._current_job,
+            "queued_jobs": len(self._queue),
+            "queue_limit": self._job_q_limit,
+            # 已经解压好的版本，dispatcher不会再发送这些版本
+            "build_md5s": self._builds.available_md5s(),
+            # 用例仓库的commit，dispatcher用来判断能否复用之前的测试结果
+            "testcase_revision": testcase_revision(CI_CONFIG.testcase_folder),
+            # 每个core最近几次启动耗时(秒)
+            "core_startup_sec": {
+                port: list(core.probe.startup_durations)
+                for port, core in self._cores.items()
+            },
+        }
 
-        start_core(job.rdscore_file_path_abs)
-        if not wait_until_core_started(timeout_sec=30):
-            job.status = TestJobStatus.failed
-            job.error = "Core did not start successfully within 30 seconds"
+    def _ensure_core(self, job: RunnerTestJob, slot: CoreSlot) -> bool:
+        """同一个版本的core已经在运行就复用，否则重启"""
+        core = self._core_for(slot)
+        if not core.ensure(slot.path, job.rdscore_md5 or job.rdscore_file_path_abs):
+            job.runner_status = TestJobStatus.failed
+            job.error = core.error
             return False
         return True
 
-    def _process_entry(self, entry, job: RunnerTestJob, run_output_path: str) -> bool:
+    def _process_entry(
+        self, entry, job: RunnerTestJob, run_output_path: str, slot: CoreSlot
+    ) -> bool:
         if entry.name in job.finished_cases:
             print(f"skip {entry.name} because it is already finished")
             return True
         if self._stop_current_job:
             self._stop_current_job = False
             print(f"{job.id} stopped")
-            job.status = TestJobStatus.failed
+            job.runner_status = TestJobStatus.failed
             job.error = "Stopped by user"
             return False
 
         job.current_case = entry.name
-        if not is_core_running():
-            start_core(job.rdscore_file_path_abs)
-        if not wait_until_core_started(timeout_sec=30):
-            job.status = TestJobStatus.failed
-            job.error = "Core did not start successfully within 30 seconds"
+        core = self._core_for(slot)
+        if not core.prepare_for_case():
+            job.runner_status = TestJobStatus.failed
+            job.error = core.error
             return False
+        core.mark_dirty()
+        self._events.push(
+            job.events_url,
+            RunnerEvent(type=RunnerEventType.case_started, job_id=job.id, case=entry.name),
+        )
+        start = time.monotonic()
 
         output_path = pathlib.Path(job.report_path, job.id, entry.name)
         os.makedirs(output_path, exist_ok=True)
         logfile = open(os.path.join(output_path, "pytest.log"), "w")
         report_html_path = os.path.join(output_path, f"{entry.name}.html")
+        junit_xml_path = os.path.join(output_path, "junit.xml")
+        # 重新执行时不要读到上一次的结果
+        if os.path.exists(junit_xml_path):
+            os.remove(junit_xml_path)
         test_ret = subprocess.call(
             [
                 CI_CONFIG.pytest_path,
                 "-m",
                 job.testcase_mark,
                 f"--html={report_html_path}",
+                f"--junitxml={junit_xml_path}",
                 "-x",
                 "--timeout=120",
                 entry.path,
             ],
             stdout=logfile,
             stderr=logfile,
+            env={**os.environ, CORE_PORT_ENV: str(slot.port)},
         )
+        logfile.close()
         print(f"{entry.name}, test result: {test_ret}, report: {report_html_path}")
         job.current_case = None
         job.finished_cases.append(entry.name)
-        subprocess.call(
-            [
-                CI_CONFIG.pytest_html_merger,
-                "-i",
-                run_output_path,
-                "-o",
-                os.path.join(run_output_path, "merged.html"),
-            ]
+        self.run_index.update(job)
+        self._events.push(
+            job.events_url,
+            RunnerEvent(
+                type=RunnerEventType.case_finished,
+                job_id=job.id,
+                case=entry.name,
+                result=test_ret,
+                duration_sec=round(time.monotonic() - start, 3),
+                tests=parse_junit_xml(junit_xml_path),
+            ),
         )
+        # 在后台合并，不阻塞下一个测试目录
+        self._report_merger.request(run_output_path)
         return True
   
     def submit_job(self, job_input: TestJob):
-        if not self.accept_test_job(job_input):
+        if not self.accept_test_job(job_input).accepted:
             return CreateTestJobResponse(created=False)
         job = RunnerTestJob(**job_input.model_dump())
-        job.status = TestJobStatus.pending
+        job.runner_status = TestJobStatus.pending
         job.testcase_folder = CI_CONFIG.testcase_folder
         job.report_path = CI_CONFIG.output_path
-        job.id = str(uuid.uuid1())
+        # 保留dispatcher分配的id，dispatcher按这个id查询结果
+        job.id = job_input.id or str(uuid.uuid1())
         job.start_time = datetime.now().isoformat()
-        job.rdscore_file_url = job_input.rdscore_file_url
+        with self._queue_cond:
+            self._queue.append(job)
+            self._prefetched[job.id] = self._prefetcher.submit(self._fetch_build, job)
+            self._queue_cond.notify_all()
         return CreateTestJobResponse(created=True, job=job)
 
     def running(self):
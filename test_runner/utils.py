@@ -3,17 +3,17 @@
 This module provides utility functions to operate core for the CoreCI test runner.
 """
 import os
+import socket
 import subprocess
 import time
+from collections import deque
 
 import requests
 
-def win_kill_proc_by_ps():
-    """Kill processes related to core on Windows using PowerShell commands."""
-    kill_rbk_command = 'Get-Process -Name rbk | Stop-Process'
-    os.system(f'powershell -Command "{kill_rbk_command}"')
-    kill_logger23_command = 'Get-Process -Name logger23 | Stop-Process'
-    os.system(f'powershell -Command "{kill_logger23_command}"')
+# 默认的core端口，多实例时每个实例使用 CORE_PORT + 序号
+CORE_PORT = 8088
+# core和测试用例通过这个环境变量得知core的端口
+CORE_PORT_ENV = "CORE_PORT"
 
 def win_kill_proc_by_port(port):
     """Kill processes listening on a specific port on Windows."""
@@ -32,85 +32,147 @@ def linux_kill_proc_by_port(port):
     os.system(cmd)
 
 
-def kill_core(core_port=8088):
-    """Kill the core service based on the operating system."""
+def kill_core(core_port=CORE_PORT):
+    """Kill the core listening on ``core_port`` based on the operating system.
+
+    The core is killed by port only, other core instances on the machine are
+    not affected.
+    """
     if os.name == "nt":
-        win_kill_proc_by_ps()
+        win_kill_proc_by_port(core_port)
     else:
         linux_kill_proc_by_port(core_port)
 
-def is_core_running():
-    """Check if the core service is running by sending a ping request."""
-    try:
-        res = requests.get("http://localhost:8088/ping")
-        if res.status_code == 200:
-            return True
-    except Exception as e:
-        print(e)
-    return False
-
-def wait_until_core_stopped(timeout_sec=10) -> bool:
-    """Wait until the core service is stopped."""
-    not_running_count = 0
-    for _ in range(timeout_sec):
+class CoreProbe:
+    """Readiness probe of one core.
+
+    A cheap TCP connect is tried before the HTTP ``/ping``, and the ping
+    reuses a keep-alive session. Polling starts with a short interval that
+    backs off up to ``max_interval_sec``, and a state counts as reached after
+    ``stable_count`` consecutive matching probes. The time each startup took
+    is kept in ``startup_durations``.
+    """
+
+    def __init__(
+        self,
+        core_port=CORE_PORT,
+        initial_interval_sec=0.05,
+        max_interval_sec=1.0,
+        backoff=1.5,
+        stable_count=2,
+        request_timeout_sec=1.0,
+    ):
+        self.core_port = core_port
+        self.initial_interval_sec = initial_interval_sec
+        self.max_interval_sec = max_interval_sec
+        self.backoff = backoff
+        self.stable_count = stable_count
+        self.request_timeout_sec = request_timeout_sec
+        self.session = requests.Session()
+        self.startup_durations: deque[float] = deque(maxlen=50)
+
+    def port_open(self) -> bool:
         try:
-            if not is_core_running():
-                not_running_count += 1
-            else:
-                not_running_count = 0
-            if not_running_count >= 3:
+            with socket.create_connection(
+                ("localhost", self.core_port), timeout=self.request_timeout_sec
+            ):
                 return True
-        except Exception as e:
-            print(e)
-        time.sleep(1)
-    return False
-
-def win_start_core(path):
-    """Start the core service on Windows."""
-    # check if path exists
-    if not os.path.exists(path):
-        raise FileNotFoundError(f"Path {path} does not exist")
-    os.chdir(path)
-    print(os.getcwd())
-    os.chdir("data/rdscore")
-
-    print(os.getcwd())
-    # why cmd /c start rbk.exe 行?
-    # why start 不行？
-    # why rbk.exe 不行?
-    p = subprocess.Popen(args=["cmd", "/c", "start", os.path.join(os.getcwd(), 'rbk.exe')], cwd=os.getcwd(),
-                         creationflags=subprocess.DETACHED_PROCESS)
-    print(p)
-    time.sleep(2)
-    wait_until_core_started()
-
+        except OSError:
+            return False
 
-def wait_until_core_started(timeout_sec=10) -> bool:
-    """Wait until the core service is started."""
-    running_count = 0
-    for _ in range(timeout_sec):
+    def is_running(self) -> bool:
+        if not self.port_open():
+            return False
         try:
-            if is_core_running():
-                running_count += 1
+            res = self.session.get(
+                f"http://localhost:{self.core_port}/ping",
+                timeout=self.request_timeout_sec,
+            )
+            return res.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def _wait_for(self, running: bool, timeout_sec) -> float | None:
+        """Return the seconds it took to reach the state, None on timeout."""
+        start = time.monotonic()
+        deadline = start + timeout_sec
+        interval = self.initial_interval_sec
+        count = 0
+        while True:
+            if self.is_running() == running:
+                count += 1
+                if count >= self.stable_count:
+                    return time.monotonic() - start
+                # 确认稳定时不需要退避
+                interval_now = self.initial_interval_sec
             else:
-                running_count = 0
-            if running_count >= 3:
-                return True
-        except Exception as e:
-            print(e)
-        time.sleep(1)
-    return False
+                count = 0
+                interval_now = interval
+                interval = min(self.max_interval_sec, interval * self.backoff)
+            if time.monotonic() + interval_now > deadline:
+                return None
+            time.sleep(interval_now)
 
+    def wait_until_started(self, timeout_sec=10) -> bool:
+        elapsed = self._wait_for(True, timeout_sec)
+        if elapsed is None:
+            return False
+        self.startup_durations.append(round(elapsed, 3))
+        print(f"core on port {self.core_port} ready after {elapsed:.2f}s")
+        return True
 
-def linux_start_core(path):
-    """Start the core service on Linux."""
-    os.system(f"cd {path} && sudo ./rbk &")
+    def wait_until_stopped(self, timeout_sec=10) -> bool:
+        return self._wait_for(False, timeout_sec) is not None
 
 
-def start_core(path):
+_probes: dict[int, CoreProbe] = {}
+
+
+def core_probe(core_port=CORE_PORT) -> CoreProbe:
+    """The shared probe of the core on ``core_port``."""
+    if core_port not in _probes:
+        _probes[core_port] = CoreProbe(core_port)
+    return _probes[core_port]
+
+
+def is_core_running(core_port=CORE_PORT):
+    """Check if the core service is running by sending a ping request."""
+    return core_probe(core_port).is_running()
+
+def wait_until_core_stopped(timeout_sec=10, core_port=CORE_PORT) -> bool:
+    """Wait until the core service is stopped."""
+    return core_probe(core_port).wait_until_stopped(timeout_sec)
+
+def wait_until_core_started(timeout_sec=10, core_port=CORE_PORT) -> bool:
+    """Wait until the core service is started."""
+    return core_probe(core_port).wait_until_started(timeout_sec)
+
+
+def popen_core(path, core_port=CORE_PORT) -> subprocess.Popen:
+    """Start the core and return the process handle without waiting.
+
+    On Linux the handle is the sudo process running rbk, terminating it
+    terminates rbk. On Windows rbk has to be started through ``cmd /c start``,
+    so the handle only belongs to cmd and the core is stopped by its port.
+    """
+    if os.name == "nt":
+        cwd = os.path.join(path, "data", "rdscore")
+        return subprocess.Popen(args=["cmd", "/c", "start", os.path.join(cwd, 'rbk.exe')], cwd=cwd,
+                                env={**os.environ, CORE_PORT_ENV: str(core_port)},
+                                creationflags=subprocess.DETACHED_PROCESS)
+    return subprocess.Popen(
+        ["sudo", "env", f"{CORE_PORT_ENV}={core_port}", "./rbk"],
+        cwd=path,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def start_core(path, core_port=CORE_PORT):
     """Start the core service based on the operating system.
 
     :param path: The path to the core service directory.
+    :param core_port: The port the core listens on, passed in CORE_PORT_ENV.
     :return: None
     :raises FileNotFoundError: If the specified path does not exist.
     :raises Exception: If the core service fails to start.
@@ -125,7 +187,49 @@ def start_core(path):
     If the service does not start within the specified timeout, it raises a TimeoutError.
 
     """
-    if os.name == "nt":
-        win_start_core(path)
-    else:
-        linux_start_core(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Path {path} does not exist")
+    print(popen_core(path, core_port))
+    time.sleep(2)
+    wait_until_core_started(core_port=core_port)
+
+
+# git rev-parse 的结果缓存时间，/info 每次心跳都会调用
+REVISION_CACHE_SEC = 30
+_revision_cache: dict[str, tuple[float, str]] = {}
+
+
+def testcase_revision(testcase_folder) -> str:
+    """测试用例仓库当前的commit，不是git仓库或有未提交的修改时返回空字符串"""
+    now = time.monotonic()
+    cached = _revision_cache.get(testcase_folder)
+    if cached is not None and now - cached[0] < REVISION_CACHE_SEC:
+        return cached[1]
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=testcase_folder, capture_output=True, text=True, timeout=5, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=testcase_folder, capture_output=True, text=True, timeout=5, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        revision, dirty = "", ""
+    if dirty:
+        # 本地修改过的用例不能和别的结果共用
+        revision = ""
+    _revision_cache[testcase_folder] = (now, revision)
+    return revision
+
+
+def dir_size(path) -> int:
+    """目录下所有文件的大小之和，不跟随符号链接"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total